@@ -0,0 +1,3 @@
+from .numba_cache import configure_cache
+
+configure_cache()
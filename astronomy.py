@@ -1,8 +1,19 @@
+import os
 import numpy as np
 import pandas as pd
 from astropy.time import Time
 from astropy.coordinates import EarthLocation
 from vtl_common.parameters import *
+from vtl_common.star_kernels import project_catalog, pixel_catalog, occupancy_counts, occupancy_fill
+from vtl_common.earth_rotation import earth_rotation_angle
+
+# Angular margin (radians) added to field of view radius when selecting stars with sky index
+FIELD_MARGIN = 1e-6
+OCCUPANCY_BLOCK_FRAMES = 1024
+CATALOG_COLUMNS = ("StarID", "RA", "Dec", "name_IAU", "BayerFlamsteed", "Hip", "HR", "Gliese")
+# Increment when contents of cached catalog files change
+CATALOG_CACHE_VERSION = 1
+
 
 def name_a_star(row):
     data = []
@@ -26,6 +37,37 @@ def name_a_star(row):
     else:
         return f"UNKNOWN (StarID {row['StarID']})"
 
+def name_stars(df):
+    '''
+    name_a_star for every row of catalog using column operations
+    :return: object array of names
+    '''
+    parts = [
+        (df["name_IAU"].notnull(), df["name_IAU"]),
+        (df["BayerFlamsteed"].notnull(), df["BayerFlamsteed"]),
+        (np.logical_and(df["Hip"].notnull(), df["Hip"] != 0), "HIP "+df["Hip"].fillna(0).astype(np.int64).astype(str)),
+        (df["HR"].notnull(), "HR "+df["HR"].fillna(0).astype(np.int64).astype(str)),
+        (df["Gliese"].notnull(), "Gliese "+df["Gliese"].astype(str)),
+    ]
+    count = np.zeros(len(df), dtype=np.int64)
+    # First three present names in order of priority
+    names = [np.full(len(df), "", dtype=object) for _ in range(3)]
+    for present, value in parts:
+        present = present.to_numpy()
+        value = np.asarray(value, dtype=object)
+        for rank in range(3):
+            selected = np.logical_and(present, count == rank)
+            names[rank][selected] = value[selected]
+        count += present
+    result = names[0].copy()
+    result[count > 1] += " ("+names[1][count > 1]
+    result[count > 2] += ", "+names[2][count > 2]
+    result[count > 1] += ")"
+    unknown = count == 0
+    result[unknown] = "UNKNOWN (StarID "+df["StarID"].astype(str).to_numpy(dtype=object)[unknown]+")"
+    return result
+
+
 class Star(object):
 
     # ra, dec in radians
@@ -63,6 +105,364 @@ class Star(object):
 
 
 
+class StarCatalog(object):
+    '''
+    Star catalog stored as contiguous arrays with precomputed trigonometric terms.
+    Projections are computed for all stars and a vector of ERA values at once, results are (T, N) arrays.
+    '''
+
+    # ra, dec in radians
+    def __init__(self, ra, dec, names=None, identifiers=None):
+        self.ra = np.ascontiguousarray(ra, dtype=np.float64)
+        self.dec = np.ascontiguousarray(dec, dtype=np.float64)
+        self.sin_ra = np.sin(self.ra)
+        self.cos_ra = np.cos(self.ra)
+        self.sin_dec = np.sin(self.dec)
+        self.cos_dec = np.cos(self.dec)
+        if names is None:
+            names = [""]*self.ra.shape[0]
+        self.names = np.asarray(names, dtype=object)
+        if identifiers is None:
+            identifiers = np.arange(self.ra.shape[0])
+        self.identifiers = np.asarray(identifiers)
+
+    @staticmethod
+    def from_dataframe(df):
+        ra = df["RA"].to_numpy(dtype=np.float64)*np.pi/12
+        dec = df["Dec"].to_numpy(dtype=np.float64)*np.pi/180
+        return StarCatalog(ra, dec, name_stars(df), df["StarID"].to_numpy())
+
+    def save(self, file_path, signature=None):
+        '''
+        Save catalog to NPZ file (names are stored as fixed width strings, no pickling)
+        :param signature: optional description of source, see load_catalog()
+        '''
+        np.savez(file_path, ra=self.ra, dec=self.dec, names=self.names.astype(str), identifiers=self.identifiers,
+                 version=CATALOG_CACHE_VERSION, signature=np.array([] if signature is None else signature))
+
+    @staticmethod
+    def load(file_path):
+        with np.load(file_path) as data:
+            return StarCatalog(data["ra"], data["dec"], data["names"], data["identifiers"])
+
+    @staticmethod
+    def from_stars(stars):
+        return StarCatalog([star.ra for star in stars], [star.dec for star in stars],
+                           [star.name for star in stars], [star.identifier for star in stars])
+
+    def __len__(self):
+        return self.ra.shape[0]
+
+    def __getitem__(self, index):
+        if np.ndim(index) == 0 and not isinstance(index, slice):
+            return Star(self.ra[index], self.dec[index], self.names[index], self.identifiers[index])
+        return self.subset(index)
+
+    def subset(self, index):
+        '''
+        Catalog of selected stars (index array, boolean mask or slice)
+        '''
+        return StarCatalog(self.ra[index], self.dec[index], self.names[index], self.identifiers[index])
+
+    @staticmethod
+    def _era_terms(era, ra0):
+        era = np.atleast_1d(np.asarray(era, dtype=np.float64))+ra0
+        return np.ascontiguousarray(np.sin(era)), np.ascontiguousarray(np.cos(era))
+
+    def get_local_coords(self, era, dec, ra0, psi, f):
+        '''
+        Star.get_local_coords for every star
+        :param era: (T,) earth rotation angles
+        :return: x, y focal plane coordinates and visibility, (T, N) each
+        '''
+        sin_a, cos_a = self._era_terms(era, ra0)
+        shape = (sin_a.shape[0], len(self))
+        x = np.empty(shape)
+        y = np.empty(shape)
+        visible = np.empty(shape, dtype=bool)
+        project_catalog(sin_a, cos_a, self.sin_ra, self.cos_ra, self.sin_dec, self.cos_dec,
+                        float(dec), float(psi), float(f), x, y, visible)
+        return x, y, visible
+
+    def get_pixel(self, era, dec, ra0, psi, f):
+        '''
+        Star.get_pixel for every star
+        :param era: (T,) earth rotation angles
+        :return: i, j pixel indices, (T, N) each, -1 outside of focal plane
+        '''
+        sin_a, cos_a = self._era_terms(era, ra0)
+        shape = (sin_a.shape[0], len(self))
+        i = np.empty(shape, dtype=np.int64)
+        j = np.empty(shape, dtype=np.int64)
+        pixel_catalog(sin_a, cos_a, self.sin_ra, self.cos_ra, self.sin_dec, self.cos_dec,
+                      float(dec), float(psi), float(f), float(PIXEL_SIZE), float(HALF_GAP_SIZE), int(HALF_PIXELS),
+                      i, j)
+        return i, j
+
+    @staticmethod
+    def field_radius(f):
+        '''
+        Angular distance from optical axis to focal plane corner
+        '''
+        half_size = HALF_GAP_SIZE+HALF_PIXELS*PIXEL_SIZE
+        return np.arctan(half_size*np.sqrt(2)/f)
+
+    def _block_candidates(self, era, dec, ra0, f, sky_index, block_frames):
+        '''
+        Stars which can be in field of view during every block of frames
+        :return: block_start, block_end, candidates (see star_kernels.occupancy_counts)
+        '''
+        blocks = (era.shape[0]+block_frames-1)//block_frames
+        if sky_index is None:
+            return np.zeros(blocks, dtype=np.int64), np.full(blocks, len(self), dtype=np.int64), \
+                np.arange(len(self), dtype=np.int64)
+        radius = self.field_radius(f)+FIELD_MARGIN
+        if abs(dec)+radius >= np.pi/2:
+            half_width = np.pi
+        else:
+            half_width = np.arcsin(np.sin(radius)/np.cos(dec))
+        found = []
+        for start in range(0, era.shape[0], block_frames):
+            angle = np.unwrap(era[start:start+block_frames])+ra0
+            found.append(sky_index.query_box(angle.min()-half_width, angle.max()+half_width,
+                                             dec-radius, dec+radius))
+        lengths = np.array([item.shape[0] for item in found], dtype=np.int64)
+        block_end = np.cumsum(lengths)
+        return block_end-lengths, block_end, np.concatenate(found).astype(np.int64)
+
+    def occupancy(self, era, dec, ra0, psi, f, sky_index=None, block_frames=OCCUPANCY_BLOCK_FRAMES):
+        '''
+        Stars on every pixel of every frame
+        :param era: (T,) earth rotation angles of frames, see earth_rotation.earth_rotation_angle()
+        :param sky_index: SkyIndex of this catalog. When given, only stars near field of view are projected
+        :param block_frames: frames per parallel work item (and per sky index query)
+        :return: StarOccupancy
+        '''
+        era = np.ascontiguousarray(np.atleast_1d(np.asarray(era, dtype=np.float64)))
+        dec = float(dec)
+        ra0 = float(ra0)
+        block_start, block_end, candidates = self._block_candidates(era, dec, ra0, f, sky_index, block_frames)
+        sin_a, cos_a = self._era_terms(era, ra0)
+        side = 2*int(HALF_PIXELS)
+        geometry = (self.sin_ra, self.cos_ra, self.sin_dec, self.cos_dec, dec, float(psi), float(f),
+                    float(PIXEL_SIZE), float(HALF_GAP_SIZE), int(HALF_PIXELS))
+        counts = np.zeros((era.shape[0], side*side), dtype=np.uint16)
+        occupancy_counts(sin_a, cos_a, block_frames, block_start, block_end, candidates, *geometry, counts)
+        frame_ptr = np.zeros(era.shape[0]+1, dtype=np.int64)
+        np.cumsum(counts.sum(axis=1, dtype=np.int64), out=frame_ptr[1:])
+        pixels = np.empty(frame_ptr[-1], dtype=np.int16)
+        stars = np.empty(frame_ptr[-1], dtype=np.int64)
+        occupancy_fill(sin_a, cos_a, block_frames, block_start, block_end, candidates, *geometry,
+                       counts, frame_ptr, pixels, stars)
+        return StarOccupancy(counts.reshape(-1, side, side), frame_ptr, pixels, stars)
+
+    def sky_index(self, band_height=None, version=None):
+        '''
+        SkyIndex over this catalog, query results index this catalog (see subset())
+        '''
+        if band_height is None:
+            band_height = SkyIndex.DEFAULT_BAND_HEIGHT
+        return SkyIndex(self.ra, self.dec, band_height, version)
+
+
+class StarOccupancy(object):
+    '''
+    Stars crossing focal plane pixels frame by frame.
+    counts: (T, W, H) number of stars on pixel. Star lists are stored frame by frame:
+    entries frame_ptr[t]:frame_ptr[t+1] of pixels (flat pixel index) and stars (catalog index) sorted by pixel
+    '''
+    def __init__(self, counts, frame_ptr, pixels, stars):
+        self.counts = counts
+        self.frame_ptr = frame_ptr
+        self.pixels = pixels
+        self.stars = stars
+
+    def __len__(self):
+        return self.counts.shape[0]
+
+    def mask(self):
+        '''
+        (T, W, H) pixels with at least one star
+        '''
+        return self.counts > 0
+
+    def frame_stars(self, t):
+        '''
+        :return: flat pixel indices and catalog indices of stars in frame t
+        '''
+        start, end = self.frame_ptr[t], self.frame_ptr[t+1]
+        return self.pixels[start:end], self.stars[start:end]
+
+    def stars_at(self, t, i, j):
+        '''
+        Catalog indices of stars on pixel (i, j) in frame t
+        '''
+        pixels, stars = self.frame_stars(t)
+        p = i*self.counts.shape[2]+j
+        return stars[np.searchsorted(pixels, p, side="left"):np.searchsorted(pixels, p, side="right")]
+
+    def star_frames(self, star):
+        '''
+        Frames and pixels (i, j) where star with catalog index star was seen
+        '''
+        entries = np.flatnonzero(self.stars == star)
+        frames = np.searchsorted(self.frame_ptr, entries, side="right")-1
+        i, j = np.divmod(self.pixels[entries].astype(np.int64), self.counts.shape[2])
+        return frames, i, j
+
+
+def star_occupancy(catalog, times, dec, ra0, psi, f, time_format="unix", dut1=None, sky_index=None,
+                   block_frames=OCCUPANCY_BLOCK_FRAMES):
+    '''
+    StarCatalog.occupancy() for frame times
+    :param times: (T,) UTC frame times, see earth_rotation.earth_rotation_angle() for time_format and dut1
+    '''
+    era = earth_rotation_angle(times, time_format, dut1)
+    return catalog.occupancy(era, dec, ra0, psi, f, sky_index, block_frames)
+
+
+class SkyIndex(object):
+    '''
+    Spatial index of stars on the sphere: declination bands of equal height,
+    stars in every band are sorted by RA. Box and cone queries return indices of stars in original order.
+    '''
+    DEFAULT_BAND_HEIGHT = np.pi/180
+    # Band number is packed with RA into one sorted key, must exceed 2*pi
+    KEY_STRIDE = 8.0
+
+    # ra, dec in radians
+    def __init__(self, ra, dec, band_height=DEFAULT_BAND_HEIGHT, version=None):
+        ra = np.mod(np.asarray(ra, dtype=np.float64), 2*np.pi)
+        dec = np.asarray(dec, dtype=np.float64)
+        self.band_height = band_height
+        self.version = version
+        band = self._band(dec)
+        order = np.lexsort((ra, band))
+        self._set_arrays(order, ra[order], dec[order])
+
+    def _set_arrays(self, order, ra, dec):
+        self.order = order
+        self.ra = ra
+        self.dec = dec
+        self.keys = self._band(dec)*self.KEY_STRIDE+ra
+        self.sin_dec = np.sin(dec)
+        self.cos_dec = np.cos(dec)
+
+    @property
+    def bands(self):
+        return int(np.ceil(np.pi/self.band_height))
+
+    def _band(self, dec):
+        return np.clip(np.floor((np.asarray(dec)+np.pi/2)/self.band_height), 0, self.bands-1).astype(np.int64)
+
+    @staticmethod
+    def _ra_intervals(ra_low, ra_high):
+        '''
+        [ra_low, ra_high] split into intervals within [0, 2*pi]. ra_low > ra_high means interval crossing 0
+        '''
+        width = ra_high-ra_low
+        if width < 0:
+            width += 2*np.pi
+        if width >= 2*np.pi:
+            return [(0.0, 2*np.pi)]
+        low = np.mod(ra_low, 2*np.pi)
+        high = low+width
+        if high <= 2*np.pi:
+            return [(low, high)]
+        return [(low, 2*np.pi), (0.0, high-2*np.pi)]
+
+    def _candidates(self, ra_low, ra_high, dec_low, dec_high):
+        '''
+        Positions in sorted arrays of stars in bands touching [dec_low, dec_high] within RA range
+        '''
+        bands = np.arange(self._band(dec_low), self._band(dec_high)+1)*self.KEY_STRIDE
+        intervals = np.array(self._ra_intervals(ra_low, ra_high))
+        starts = np.searchsorted(self.keys, (bands[:, None]+intervals[None, :, 0]).ravel(), side="left")
+        ends = np.searchsorted(self.keys, (bands[:, None]+intervals[None, :, 1]).ravel(), side="right")
+        lengths = ends-starts
+        offsets = np.cumsum(lengths)-lengths
+        return np.arange(lengths.sum())-np.repeat(offsets-starts, lengths)
+
+    def query_box(self, ra_low, ra_high, dec_low, dec_high):
+        '''
+        Stars with dec in [dec_low, dec_high] and RA in [ra_low, ra_high] (angles wrap around, see range_calculate)
+        :return: sorted star indices
+        '''
+        positions = self._candidates(ra_low, ra_high, dec_low, dec_high)
+        dec = self.dec[positions]
+        positions = positions[np.logical_and(dec >= dec_low, dec <= dec_high)]
+        return np.sort(self.order[positions])
+
+    def query_cone(self, ra, dec, radius):
+        '''
+        Stars within angular distance radius of (ra, dec)
+        :return: sorted star indices
+        '''
+        dec_low = max(dec-radius, -np.pi/2)
+        dec_high = min(dec+radius, np.pi/2)
+        if abs(dec)+radius >= np.pi/2:
+            ra_low, ra_high = 0.0, 2*np.pi
+        else:
+            half_width = np.arcsin(min(np.sin(radius)/np.cos(dec), 1.0))
+            ra_low, ra_high = ra-half_width, ra+half_width
+        positions = self._candidates(ra_low, ra_high, dec_low, dec_high)
+        cos_distance = (np.sin(dec)*self.sin_dec[positions] +
+                        np.cos(dec)*self.cos_dec[positions]*np.cos(self.ra[positions]-ra))
+        return np.sort(self.order[positions[cos_distance >= np.cos(radius)]])
+
+    def save(self, file_path):
+        np.savez(file_path, order=self.order, ra=self.ra, dec=self.dec, band_height=self.band_height,
+                 version="" if self.version is None else str(self.version))
+
+    @staticmethod
+    def load(file_path):
+        with np.load(file_path) as data:
+            index = SkyIndex.__new__(SkyIndex)
+            index.band_height = float(data["band_height"])
+            index.version = str(data["version"]) or None
+            index._set_arrays(data["order"], data["ra"], data["dec"])
+        return index
+
+
+def _source_signature(file_path):
+    stat = os.stat(file_path)
+    return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+
+def _cache_is_valid(cache_path, signature):
+    try:
+        with np.load(cache_path) as data:
+            return int(data["version"]) == CATALOG_CACHE_VERSION and np.array_equal(data["signature"], signature)
+    except (OSError, KeyError, ValueError):
+        return False
+
+
+def load_catalog(csv_path, cache_path=None, use_cache=True):
+    '''
+    Load star catalog CSV (RA in hours, Dec in degrees) as StarCatalog.
+    Parsed catalog is cached in NPZ file which is rebuilt when size or modification time of CSV changes.
+    Cache is skipped silently when it cannot be written.
+    :param cache_path: csv_path with .npz suffix by default
+    '''
+    if not use_cache:
+        return StarCatalog.from_dataframe(pd.read_csv(csv_path, usecols=lambda column: column in CATALOG_COLUMNS))
+    if cache_path is None:
+        cache_path = os.path.splitext(csv_path)[0]+".npz"
+    signature = _source_signature(csv_path)
+    if _cache_is_valid(cache_path, signature):
+        return StarCatalog.load(cache_path)
+    catalog = load_catalog(csv_path, use_cache=False)
+    temp_path = cache_path+".tmp"
+    try:
+        with open(temp_path, "wb") as fp:
+            catalog.save(fp, signature)
+        os.replace(temp_path, cache_path)
+    except OSError:
+        if os.path.isfile(temp_path):
+            os.remove(temp_path)
+    return catalog
+
+
 def range_calculate(params:dict, t1: Time, t2:Time):
     ra0 = params["ra0"] * np.pi / 180
     dec0 = params["dec0"] * np.pi / 180
@@ -0,0 +1,119 @@
+'''
+Compact layout of alive pixels: (T, n_alive) arrays instead of (T, W, H) with broken pixels.
+'''
+import numpy as np
+import numba as nb
+from numba import prange
+
+
+@nb.njit(parallel=True, cache=True)
+def gather_pixels(frames, indices, out):
+    T = frames.shape[0]
+    N = indices.shape[0]
+    for t in prange(T):
+        for n in range(N):
+            out[t, n] = frames[t, indices[n]]
+
+
+@nb.njit(parallel=True, cache=True)
+def scatter_pixels(compact, indices, fill, out):
+    T, P = out.shape
+    N = indices.shape[0]
+    for t in prange(T):
+        for p in range(P):
+            out[t, p] = fill
+        for n in range(N):
+            out[t, indices[n]] = compact[t, n]
+
+
+@nb.njit(parallel=True, cache=True)
+def scatter_columns(compact, indices, out):
+    T = out.shape[0]
+    N = indices.shape[0]
+    for t in prange(T):
+        for n in range(N):
+            out[t, indices[n]] = compact[t, n]
+
+
+def pixel_indices(indices, pixel_shape):
+    '''
+    Flat pixel indices from (N, 2) list of (i, j) or from boolean mask
+    '''
+    indices = np.asarray(indices)
+    if indices.dtype == bool:
+        if indices.shape != tuple(pixel_shape):
+            raise ValueError(f"Pixel mask shape {indices.shape} does not match {tuple(pixel_shape)}")
+        return np.flatnonzero(indices.ravel())
+    indices = indices.reshape(-1, 2)
+    return np.ravel_multi_index((indices[:, 0], indices[:, 1]), pixel_shape)
+
+
+class AliveLayout(object):
+    '''
+    Index map between full pixel grid and compact array of alive pixels
+    '''
+    def __init__(self, broken):
+        broken = np.asarray(broken, dtype=bool)
+        self._set_indices(np.flatnonzero(np.logical_not(broken.ravel())), broken.shape)
+
+    def _set_indices(self, indices, pixel_shape):
+        self.pixel_shape = tuple(pixel_shape)
+        self.indices = np.ascontiguousarray(indices, dtype=np.int64)
+        self.key = self.indices.tobytes()
+
+    @classmethod
+    def from_indices(cls, indices, pixel_shape):
+        '''
+        Layout of arbitrary pixel selection ((N, 2) list of (i, j) or boolean mask)
+        '''
+        layout = cls.__new__(cls)
+        layout._set_indices(pixel_indices(indices, pixel_shape), pixel_shape)
+        return layout
+
+    @property
+    def pixels(self):
+        return int(np.prod(self.pixel_shape))
+
+    @property
+    def n_alive(self):
+        return self.indices.shape[0]
+
+    def alive_mask(self):
+        mask = np.zeros(self.pixels, dtype=bool)
+        mask[self.indices] = True
+        return mask.reshape(self.pixel_shape)
+
+    def compress(self, pixel_data, out=None):
+        '''
+        (..., W, H) -> (T, n_alive)
+        '''
+        pixel_data = np.asarray(pixel_data)
+        frames = pixel_data.reshape(-1, self.pixels)
+        if out is None:
+            out = np.empty((frames.shape[0], self.n_alive), dtype=pixel_data.dtype)
+        gather_pixels(frames, self.indices, out)
+        return out
+
+    def expand(self, compact, out=None, fill=0.0):
+        '''
+        (T, n_alive) -> (T, W, H), broken pixels are set to fill
+        '''
+        compact = np.asarray(compact)
+        if out is None:
+            out = np.empty((compact.shape[0],)+self.pixel_shape, dtype=compact.dtype)
+        scatter_pixels(compact, self.indices, fill, out.reshape(-1, self.pixels))
+        return out
+
+    def scatter(self, compact, out):
+        '''
+        Write (T, n_alive) data to own pixels of (T, W, H) out keeping other pixels
+        '''
+        scatter_columns(np.asarray(compact), self.indices, out.reshape(-1, self.pixels))
+        return out
+
+    def gather_parameter(self, value):
+        '''
+        Per-pixel parameter (scalar or array with pixels in last axes) restricted to alive pixels
+        '''
+        value = np.broadcast_to(np.asarray(value, dtype=np.float64).reshape(-1), (self.pixels,))
+        return np.ascontiguousarray(value[self.indices])
@@ -0,0 +1,327 @@
+'''
+Batch flat fielding of HDF5 recordings in a process pool.
+Model parameter arrays are placed in shared memory once and viewed by every worker without copying.
+Every input produces its own output file; completed files are recorded in a state file so an interrupted run
+continues where it stopped.
+Run as python -m vtl_common.common_flatfielding.batch model.json output_dir input1.h5 input2.h5 ...
+'''
+import json
+import os
+import os.path as ospath
+from multiprocessing import cpu_count, get_context, shared_memory
+
+import h5py
+import numpy as np
+
+from .models import FlatFieldingModel
+from .streaming import apply_stream, create_output_dataset
+from .result_cache import model_digest
+
+STATE_FILE = "batch_state.json"
+# Numba threading layer is not fork-safe once parallel kernels have run in the parent
+START_METHOD = "spawn"
+OUTPUT_SUFFIX = "_ff"
+# Smaller arrays are pickled to workers as is
+SHARED_THRESHOLD_BYTES = 1 << 12
+SHARED_MARKER = "__shared__"
+# Model attributes selecting evaluation path (see FlatFieldingModel.evaluation_mode()), not part of dump()
+EVALUATION_SETTINGS = ("lut_max_count", "surrogate_settings", "evaluation_cache", "fused")
+
+
+def default_processes():
+    '''
+    NPROC setting if settings are loaded, otherwise number of CPUs
+    '''
+    try:
+        from vtl_common import parameters
+    except ImportError:
+        return cpu_count()
+    return getattr(parameters, "NPROC", cpu_count())
+
+
+def evaluation_settings(model):
+    '''
+    Evaluation settings of model and of its submodels
+    '''
+    return {"settings": {key: getattr(model, key) for key in EVALUATION_SETTINGS if hasattr(model, key)},
+            "models": [evaluation_settings(item) for item in getattr(model, "models", [])]}
+
+
+def restore_evaluation_settings(model, settings):
+    for key, value in settings["settings"].items():
+        setattr(model, key, value)
+    for item, item_settings in zip(getattr(model, "models", []), settings["models"]):
+        restore_evaluation_settings(item, item_settings)
+
+
+class SharedModel(object):
+    '''
+    Raw model dump and evaluation settings with large arrays moved to shared memory.
+    Picklable description is passed to workers, which rebuild the model with build()
+    '''
+    def __init__(self, model):
+        self.blocks = []
+        self.dtype = model.dtype.str
+        self.description = self._share(model.dump(raw=True))
+        self.settings = self._share(evaluation_settings(model))
+
+    def _share(self, value):
+        if isinstance(value, dict):
+            return {key: self._share(item) for key, item in value.items()}
+        if isinstance(value, (list, tuple)):
+            return type(value)(self._share(item) for item in value)
+        if isinstance(value, np.ndarray) and value.nbytes >= SHARED_THRESHOLD_BYTES:
+            block = shared_memory.SharedMemory(create=True, size=value.nbytes)
+            np.ndarray(value.shape, dtype=value.dtype, buffer=block.buf)[...] = value
+            self.blocks.append(block)
+            return {SHARED_MARKER: block.name, "shape": value.shape, "dtype": value.dtype.str}
+        return value
+
+    def close(self):
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+
+    def __getstate__(self):
+        return {"blocks": [], "dtype": self.dtype, "description": self.description, "settings": self.settings}
+
+    @staticmethod
+    def _restore(value, attached):
+        if isinstance(value, dict):
+            if SHARED_MARKER in value:
+                # Pool workers share resource tracker of parent, which unlinks blocks in close()
+                block = shared_memory.SharedMemory(name=value[SHARED_MARKER])
+                attached.append(block)
+                array = np.ndarray(tuple(value["shape"]), dtype=np.dtype(value["dtype"]), buffer=block.buf)
+                array.flags.writeable = False
+                return array
+            return {key: SharedModel._restore(item, attached) for key, item in value.items()}
+        if isinstance(value, (list, tuple)):
+            return type(value)(SharedModel._restore(item, attached) for item in value)
+        return value
+
+    def build(self, attached):
+        '''
+        Model viewing shared arrays. Attached blocks are appended to attached and must outlive the model
+        '''
+        model = FlatFieldingModel.create_from_parameters(self._restore(self.description, attached))
+        model.set_dtype(self.dtype)
+        restore_evaluation_settings(model, self._restore(self.settings, attached))
+        return model
+
+
+# Worker process state
+_worker_model = None
+_worker_blocks = []
+
+
+def _init_worker(shared_model):
+    global _worker_model
+    # Parallelism comes from processes, numba threads would oversubscribe CPUs
+    import numba
+    numba.set_num_threads(1)
+    _worker_model = shared_model.build(_worker_blocks)
+
+
+def find_dataset(fp, dataset=None):
+    '''
+    Named dataset or first 3D dataset of file
+    '''
+    if dataset is not None:
+        return fp[dataset]
+    found = []
+
+    def visitor(name, item):
+        if isinstance(item, h5py.Dataset) and item.ndim == 3:
+            found.append(item)
+            return True
+    fp.visititems(visitor)
+    if not found:
+        raise KeyError(f"No (T, W, H) dataset in {fp.filename}")
+    return found[0]
+
+
+def output_path(input_path, output_dir, suffix=OUTPUT_SUFFIX):
+    stem, extension = ospath.splitext(ospath.basename(input_path))
+    return ospath.join(output_dir, stem+suffix+(extension or ".h5"))
+
+
+def output_paths(inputs, output_dir, suffix=OUTPUT_SUFFIX):
+    '''
+    Output path for every input, ValueError if two inputs (equal names in different directories
+    or repeated input) would write the same output
+    '''
+    targets = [output_path(input_path, output_dir, suffix) for input_path in inputs]
+    owners = dict()
+    for input_path, target_path in zip(inputs, targets):
+        key = ospath.normcase(ospath.abspath(target_path))
+        if key in owners:
+            raise ValueError(f"Inputs {owners[key]} and {input_path} have the same output {target_path}")
+        owners[key] = input_path
+    return targets
+
+
+def copy_except(src_group, dst_group, skip):
+    '''
+    Copy contents of h5py group except object with absolute name skip.
+    Groups on the way to skipped object are recreated with their attributes
+    '''
+    for name, item in src_group.items():
+        if item.name == skip:
+            continue
+        if isinstance(item, h5py.Group) and skip.startswith(item.name+"/"):
+            target = dst_group.require_group(name)
+            target.attrs.update(item.attrs)
+            copy_except(item, target, skip)
+        else:
+            src_group.copy(item, dst_group, name=name)
+
+
+def process_file(model, input_path, target_path, dataset=None, chunk_frames=None, nobreak=True):
+    '''
+    Flat field one recording. Other datasets of input are copied as is.
+    Output is written to temporary file and renamed when complete.
+    '''
+    temp_path = target_path+".part"
+    with h5py.File(input_path, "r") as src_file, h5py.File(temp_path, "w") as dst_file:
+        src = find_dataset(src_file, dataset)
+        copy_except(src_file, dst_file, src.name)
+        dst = create_output_dataset(dst_file, src.name, src, model)
+        dst.attrs.update(src.attrs)
+        apply_stream(model, src, dst, chunk_frames, nobreak)
+    os.replace(temp_path, target_path)
+    return target_path
+
+
+def _process_job(job):
+    input_path, target_path, dataset, chunk_frames, nobreak = job
+    try:
+        process_file(_worker_model, input_path, target_path, dataset, chunk_frames, nobreak)
+        return input_path, target_path, None
+    except Exception as e:
+        return input_path, target_path, f"{type(e).__name__}: {e}"
+
+
+class BatchState(object):
+    '''
+    JSON record of completed inputs. Entry is valid while model digest, input size and mtime match
+    and output exists.
+    '''
+    def __init__(self, file_path, digest):
+        self.file_path = file_path
+        self.digest = digest
+        self.completed = dict()
+        if ospath.isfile(file_path):
+            with open(file_path, "r") as fp:
+                self.completed = json.load(fp).get("completed", dict())
+
+    @staticmethod
+    def _signature(input_path):
+        stat = os.stat(input_path)
+        return {"size": stat.st_size, "mtime": stat.st_mtime}
+
+    def is_done(self, input_path):
+        entry = self.completed.get(ospath.abspath(input_path))
+        return (entry is not None and entry["digest"] == self.digest and ospath.isfile(entry["output"])
+                and all(entry[key] == value for key, value in self._signature(input_path).items()))
+
+    def output(self, input_path):
+        return self.completed[ospath.abspath(input_path)]["output"]
+
+    def mark_done(self, input_path, target_path):
+        entry = {"output": ospath.abspath(target_path), "digest": self.digest}
+        entry.update(self._signature(input_path))
+        self.completed[ospath.abspath(input_path)] = entry
+        temp_path = self.file_path+".tmp"
+        with open(temp_path, "w") as fp:
+            json.dump({"completed": self.completed}, fp, indent=4, sort_keys=True)
+        os.replace(temp_path, self.file_path)
+
+
+def run_batch(model, inputs, output_dir, dataset=None, processes=None, state_file=None, chunk_frames=None,
+              nobreak=True, suffix=OUTPUT_SUFFIX, progress=None):
+    '''
+    Flat field HDF5 recordings in a process pool
+    :param model: FlatFieldingModel or path to saved model
+    :param inputs: input file paths
+    :param output_dir: directory for outputs (input name with suffix), input names must be unique
+    :param dataset: name of (T, W, H) dataset, first 3D dataset of file by default
+    :param processes: pool size, NPROC by default. 1 processes files in this process.
+    Workers are spawned, so scripts using several processes need an if __name__ == "__main__" guard
+    :param state_file: resumable state, batch_state.json in output_dir by default
+    :param progress: optional callable(done_files, total_files, input_path, error)
+    :return: dict of input -> output for completed files and dict of input -> error message for failed ones
+    '''
+    if not isinstance(model, FlatFieldingModel):
+        model = FlatFieldingModel.load(model)
+    if processes is None:
+        processes = default_processes()
+    targets = output_paths(inputs, output_dir, suffix)
+    os.makedirs(output_dir, exist_ok=True)
+    if state_file is None:
+        state_file = ospath.join(output_dir, STATE_FILE)
+    digest = model_digest(model)
+    digest.update(str((nobreak, dataset)).encode())
+    state = BatchState(state_file, digest.hexdigest())
+    completed = dict()
+    errors = dict()
+    jobs = []
+    for input_path, target_path in zip(inputs, targets):
+        if state.is_done(input_path):
+            completed[input_path] = state.output(input_path)
+        else:
+            jobs.append((input_path, target_path, dataset, chunk_frames, nobreak))
+    total = len(inputs)
+
+    def finish(input_path, target_path, error):
+        if error is None:
+            state.mark_done(input_path, target_path)
+            completed[input_path] = target_path
+        else:
+            errors[input_path] = error
+        if progress is not None:
+            progress(len(completed)+len(errors), total, input_path, error)
+
+    if processes <= 1 or len(jobs) <= 1:
+        global _worker_model
+        _worker_model = model
+        try:
+            for job in jobs:
+                finish(*_process_job(job))
+        finally:
+            _worker_model = None
+    else:
+        shared = SharedModel(model)
+        try:
+            context = get_context(START_METHOD)
+            with context.Pool(min(processes, len(jobs)), initializer=_init_worker, initargs=(shared,)) as pool:
+                for result in pool.imap_unordered(_process_job, jobs):
+                    finish(*result)
+        finally:
+            shared.close()
+    return completed, errors
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Flat field HDF5 recordings")
+    parser.add_argument("model", help="Saved flat fielding model (JSON or HDF5)")
+    parser.add_argument("output_dir")
+    parser.add_argument("inputs", nargs="+")
+    parser.add_argument("--dataset", default=None)
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--chunk-frames", type=int, default=None)
+    args = parser.parse_args()
+
+    def report(done, total, input_path, error):
+        status = "failed: "+error if error else "done"
+        print(f"[{done}/{total}] {input_path} {status}")
+
+    _, errors = run_batch(args.model, args.inputs, args.output_dir, args.dataset, args.processes,
+                          chunk_frames=args.chunk_frames, progress=report)
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
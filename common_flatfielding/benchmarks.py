@@ -0,0 +1,141 @@
+'''
+Timing of flat fielding paths on synthetic data.
+Run as python -m vtl_common.common_flatfielding.benchmarks
+'''
+import json
+import os
+import os.path as ospath
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+
+from .models import Linear, NonlinearPileup, Chain, PixelModelMap
+from .warmup import synthetic_models, synthetic_signal
+from .lambertw import lambertw_real
+
+
+def timeit(func, repeats=3):
+    func()  # Compilation and caches
+    best = np.inf
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter()-start)
+    return best
+
+
+def benchmark_chain(frames=20000, seed=0):
+    '''
+    Compare fused Chain evaluation against stage by stage application
+    '''
+    rng = np.random.default_rng(seed)
+    signal = synthetic_signal(rng, frames)
+    linear, saturation, interpolative = synthetic_models(rng)
+    second_linear = Linear(rng.uniform(0.5, 2.0, (16, 16)), rng.uniform(0.0, 3.0, (16, 16)))
+    chains = [
+        Chain([linear, second_linear]),
+        Chain([saturation, linear, second_linear]),
+        Chain([saturation, linear, interpolative]),
+    ]
+    out = np.empty(signal.shape)
+    for chain in chains:
+        chain.fused = False
+        reference = chain.apply(signal)
+        stagewise = timeit(lambda: chain.apply(signal, out=out))
+        chain.fused = True
+        error = np.max(np.abs(chain.apply(signal)-reference)/(1+np.abs(reference)))
+        fused = timeit(lambda: chain.apply(signal, out=out))
+        chain.fused = None
+        print(f"{chain}: stage by stage {stagewise:.4f} s, fused {fused:.4f} s, "
+              f"speedup {stagewise/fused:.2f}x, max rel. error {error:.2e}, default fused {chain.is_fused()}")
+
+
+def benchmark_lambertw(samples=5000000, seed=0):
+    '''
+    Accuracy and throughput of compiled W0 against scipy.special.lambertw on [-1/e, 0]
+    '''
+    from scipy.special import lambertw
+    rng = np.random.default_rng(seed)
+    x = rng.uniform(-1/np.e, 0.0, samples)
+    # Dense sampling near branch point where W0 is worst conditioned
+    x[:1000] = -1/np.e+np.logspace(-16, -2, 1000)
+    reference = lambertw(x).real
+    compiled = lambertw_real(x)
+    valid = np.isfinite(reference)
+    abs_error = np.max(np.abs(compiled-reference)[valid])
+    residual = np.max(np.abs(compiled*np.exp(compiled)-x))
+    scipy_time = timeit(lambda: lambertw(x).real)
+    compiled_time = timeit(lambda: lambertw_real(x))
+    print(f"lambertw: max abs. error vs scipy {abs_error:.2e}, max residual |w*exp(w)-x| {residual:.2e}")
+    print(f"lambertw: scipy {samples/scipy_time/1e6:.1f} M/s, compiled {samples/compiled_time/1e6:.1f} M/s, "
+          f"speedup {scipy_time/compiled_time:.2f}x")
+
+
+def float32_accuracy(frames=20000, seed=0):
+    '''
+    Maximum relative error of float32 compute mode against float64 for every model
+    '''
+    rng = np.random.default_rng(seed)
+    signal = synthetic_signal(rng, frames)
+    linear, saturation, interpolative = synthetic_models(rng)
+    pileup = NonlinearPileup(rng.uniform(0.5, 2.0, (16, 16)), rng.uniform(2000.0, 4000.0, (16, 16)), 1.0,
+                             rng.uniform(0.0, 1.0, (16, 16)))
+    mask = rng.random((16, 16))
+    model_map = PixelModelMap([saturation, pileup], np.where(mask < 0.5, 0, np.where(mask < 0.9, 1, -1)))
+    models = [linear, saturation, pileup, interpolative, Chain([saturation, linear, interpolative]), model_map]
+    signal32 = signal.astype(np.float32)
+    for model in models:
+        model.set_dtype(np.float64)
+        reference = model.apply(signal)
+        double_time = timeit(lambda: model.apply(signal))
+        model.set_dtype(np.float32)
+        result = model.apply(signal32)
+        single_time = timeit(lambda: model.apply(signal32))
+        assert result.dtype == np.float32
+        scale = np.maximum(np.abs(reference), np.finfo(np.float32).eps*np.max(np.abs(reference)))
+        error = np.max(np.abs(result-reference)/scale)
+        print(f"{model}: float32 max rel. error {error:.2e}, float64 {double_time:.4f} s, "
+              f"float32 {single_time:.4f} s")
+        model.set_dtype(np.float64)
+
+
+STARTUP_SCRIPT = """
+import json, time
+start = time.perf_counter()
+from vtl_common.common_flatfielding.warmup import warmup
+imported = time.perf_counter()
+first = warmup()
+second = warmup()
+print(json.dumps({"import": imported-start, "first": first, "second": second}))
+"""
+
+
+def _startup_run(cache_dir):
+    environment = dict(os.environ)
+    environment["NUMBA_CACHE_DIR"] = cache_dir
+    # Directory containing vtl_common package
+    root = ospath.dirname(ospath.dirname(ospath.dirname(ospath.abspath(__file__))))
+    environment["PYTHONPATH"] = os.pathsep.join(filter(None, [root, environment.get("PYTHONPATH")]))
+    output = subprocess.check_output([sys.executable, "-c", STARTUP_SCRIPT], env=environment)
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def benchmark_startup():
+    '''
+    Fresh interpreter startup with empty and with populated numba cache.
+    First warmup() includes compilation (or cache loading), second one is pure run time.
+    '''
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for title in ("empty cache", "populated cache"):
+            timing = _startup_run(cache_dir)
+            print(f"startup with {title}: import {timing['import']:.2f} s, "
+                  f"compile/load {timing['first']-timing['second']:.2f} s, run {timing['second']:.3f} s")
+
+
+if __name__ == "__main__":
+    benchmark_chain()
+    benchmark_lambertw()
+    float32_accuracy()
+    benchmark_startup()
@@ -0,0 +1,187 @@
+'''
+Data-driven broken pixel detection.
+Recording is scanned chunk by chunk keeping only per-pixel running statistics,
+resulting mask can be passed to FlatFieldingModel.set_broken().
+'''
+import numpy as np
+import numba as nb
+from numba import prange
+
+from .streaming import aligned_chunk_frames
+
+# Scale of median absolute deviation to standard deviation for normal distribution
+MAD_SCALE = 1.4826
+
+
+@nb.njit(parallel=True, cache=True)
+def accumulate_pixel_statistics(frames, spike_sigma, warmup, count, mean, m2, zeros, spikes):
+    '''
+    Welford update of per-pixel mean and variance, counting zero samples and spikes.
+    Sample is a spike when it deviates from running mean by more than spike_sigma standard deviations
+    (checked only after warmup samples). NaN samples are skipped.
+    '''
+    T, P = frames.shape
+    for p in prange(P):
+        n = count[p]
+        mu = mean[p]
+        s = m2[p]
+        z = zeros[p]
+        k = spikes[p]
+        for t in range(T):
+            x = frames[t, p]
+            if x != x:
+                continue
+            if x == 0.0:
+                z += 1
+            delta = x-mu
+            if n >= warmup and n > 1:
+                limit = spike_sigma*np.sqrt(s/(n-1))
+                if abs(delta) > limit:
+                    k += 1
+            n += 1
+            mu += delta/n
+            s += delta*(x-mu)
+        count[p] = n
+        mean[p] = mu
+        m2[p] = s
+        zeros[p] = z
+        spikes[p] = k
+
+
+def robust_score(values, mask=None):
+    '''
+    Deviation from median in units of scaled median absolute deviation
+    :param mask: pixels used for median and MAD estimation
+    '''
+    reference = values if mask is None else values[mask]
+    reference = reference[np.isfinite(reference)]
+    if reference.shape[0] == 0:
+        return np.zeros(values.shape)
+    median = np.median(reference)
+    spread = MAD_SCALE*np.median(np.abs(reference-median))
+    if spread == 0:
+        spread = np.finfo(np.float64).tiny
+    return (values-median)/spread
+
+
+class BrokenPixelDetector(object):
+    '''
+    Streaming per-pixel statistics for hot, cold, dead, noisy and flickering pixel detection.
+    Detectors of different chunks or files can be merged (spikes are summed as is).
+    '''
+    def __init__(self, pixel_shape=(16, 16), spike_sigma=6.0, warmup=32):
+        '''
+        :param spike_sigma: deviation from running mean (in standard deviations) counted as spike
+        :param warmup: samples before spike counting starts
+        '''
+        self.pixel_shape = tuple(pixel_shape)
+        self.spike_sigma = spike_sigma
+        self.warmup = warmup
+        pixels = int(np.prod(self.pixel_shape))
+        self.count = np.zeros(pixels, dtype=np.int64)
+        self.mean = np.zeros(pixels)
+        self.m2 = np.zeros(pixels)
+        self.zeros = np.zeros(pixels, dtype=np.int64)
+        self.spikes = np.zeros(pixels, dtype=np.int64)
+
+    def update(self, pixel_data):
+        '''
+        Add (T, W, H) chunk of signal
+        '''
+        pixel_data = np.asarray(pixel_data, dtype=np.float64)
+        frames = pixel_data.reshape(pixel_data.shape[0], -1)
+        accumulate_pixel_statistics(frames, self.spike_sigma, self.warmup,
+                                    self.count, self.mean, self.m2, self.zeros, self.spikes)
+        return self
+
+    def update_stream(self, src, chunk_frames=None, progress=None):
+        '''
+        Scan whole (T, W, H) dataset reading it in chunks aligned to its HDF5 layout
+        :param progress: optional callable(done_frames, total_frames)
+        '''
+        chunk_frames = aligned_chunk_frames(src, chunk_frames)
+        length = src.shape[0]
+        for start in range(0, length, chunk_frames):
+            end = min(start+chunk_frames, length)
+            self.update(src[start:end])
+            if progress is not None:
+                progress(end, length)
+        return self
+
+    def merge(self, other):
+        total = self.count+other.count
+        with np.errstate(divide="ignore", invalid="ignore"):
+            weight = np.where(total > 0, other.count/total, 0.0)
+        delta = other.mean-self.mean
+        self.m2 = self.m2+other.m2+delta*delta*self.count*weight
+        self.mean = self.mean+delta*weight
+        self.count = total
+        self.zeros = self.zeros+other.zeros
+        self.spikes = self.spikes+other.spikes
+        return self
+
+    def _per_count(self, value):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(self.count > 0, value/self.count, np.nan).reshape(self.pixel_shape)
+
+    def get_mean(self):
+        return np.where(self.count > 0, self.mean, np.nan).reshape(self.pixel_shape)
+
+    def get_std(self):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.sqrt(np.where(self.count > 1, self.m2/(self.count-1), np.nan)).reshape(self.pixel_shape)
+
+    def get_zero_fraction(self):
+        return self._per_count(self.zeros)
+
+    def get_spike_rate(self):
+        return self._per_count(self.spikes)
+
+    def classify(self, hot_sigma=5.0, cold_sigma=5.0, noise_sigma=5.0, max_zero_fraction=0.5,
+                 max_spike_rate=1e-3, min_std=1e-8, min_count=2):
+        '''
+        Masks of suspicious pixels by reason. Thresholds set to None are not checked.
+        :param hot_sigma: robust score of pixel mean above which pixel is hot
+        :param cold_sigma: robust score of pixel mean below which (negated) pixel is cold
+        :param noise_sigma: robust score of pixel standard deviation above which pixel is noisy
+        :param max_zero_fraction: fraction of exact zeros above which pixel is dead
+        :param max_spike_rate: fraction of spike samples above which pixel is flickering
+        :param min_std: standard deviation below which pixel is stuck
+        :param min_count: pixels with fewer valid samples are marked as empty
+        :return: dict of (W, H) boolean masks
+        '''
+        mean = self.get_mean()
+        std = self.get_std()
+        empty = (self.count < min_count).reshape(self.pixel_shape)
+        valid = np.logical_not(empty)
+        result = {"empty": empty}
+        if hot_sigma is not None or cold_sigma is not None:
+            score = robust_score(mean, valid)
+            if hot_sigma is not None:
+                result["hot"] = np.logical_and(valid, score > hot_sigma)
+            if cold_sigma is not None:
+                result["cold"] = np.logical_and(valid, score < -cold_sigma)
+        if noise_sigma is not None:
+            result["noisy"] = np.logical_and(valid, robust_score(std, valid) > noise_sigma)
+        if max_zero_fraction is not None:
+            result["dead"] = np.logical_and(valid, self.get_zero_fraction() > max_zero_fraction)
+        if max_spike_rate is not None:
+            result["flickering"] = np.logical_and(valid, self.get_spike_rate() > max_spike_rate)
+        if min_std is not None:
+            result["stuck"] = np.logical_and(valid, std <= min_std)
+        return result
+
+    def broken_mask(self, **thresholds):
+        '''
+        (W, H) mask of pixels flagged for any reason, see classify() for thresholds
+        '''
+        return np.logical_or.reduce(list(self.classify(**thresholds).values()))
+
+
+def detect_broken(src, chunk_frames=None, spike_sigma=6.0, warmup=32, progress=None, **thresholds):
+    '''
+    Scan (T, W, H) recording and return broken pixel mask
+    '''
+    detector = BrokenPixelDetector(tuple(src.shape[1:]), spike_sigma=spike_sigma, warmup=warmup)
+    detector.update_stream(src, chunk_frames, progress)
+    return detector.broken_mask(**thresholds)
@@ -0,0 +1,189 @@
+import numpy as np
+import numba as nb
+from numba import prange
+
+from .kernels import saturation_value, pileup_value, affine_frames
+from .matrix_interpolation import interpolate_segment, TIME_BLOCK
+
+# Stage descriptors produced by FlatFieldingModel._apply_stages():
+#   ("affine", a, b)                         -- y = a*x+b, a and b are scalars or per-pixel maps
+#   ("saturation", (inv_a, inv_b, offset))   -- NonlinearSaturation.evaluate
+#   ("interpolative", (knots, values, slopes)) -- Interpolative.evaluate
+#   ("pileup", (divider, scale))             -- NonlinearPileup.evaluate for prescaled input, without offset
+#   ("model", model)                         -- anything else, evaluated by model.apply()
+STAGE_SATURATION = 1
+STAGE_INTERPOLATIVE = 2
+STAGE_PILEUP = 3
+
+
+@nb.njit(parallel=True, cache=True)
+def run_program(frames, pre, kinds, params, post, table_start, table_size, knots, values, slopes, broken, out):
+    T, P = frames.shape
+    S = kinds.shape[0]
+    limit = np.finfo(out.dtype).max
+    blocks = (T+TIME_BLOCK-1)//TIME_BLOCK
+    for block in prange(blocks):
+        # Interpolation segment hints for every pixel and stage
+        hints = np.zeros((P, S), dtype=np.int64)
+        start = block*TIME_BLOCK
+        end = min(start+TIME_BLOCK, T)
+        for t in range(start, end):
+            for p in range(P):
+                if broken[p]:
+                    out[t, p] = 0.0
+                    continue
+                x = pre[0, p]*frames[t, p]+pre[1, p]
+                for s in range(S):
+                    kind = kinds[s]
+                    if kind == STAGE_SATURATION:
+                        x = saturation_value(x, params[s, 0, p], params[s, 1, p], params[s, 2, p])
+                    elif kind == STAGE_PILEUP:
+                        x = pileup_value(x, params[s, 0, p], params[s, 1, p], limit)
+                    elif kind == STAGE_INTERPOLATIVE:
+                        if table_size[s] == 1:
+                            x = values[p, table_start[s]]
+                        else:
+                            x, hints[p, s] = interpolate_segment(x, knots, values, slopes, p,
+                                                                 table_start[s], table_size[s], hints[p, s])
+                    x = post[s, 0, p]*x+post[s, 1, p]
+                out[t, p] = x
+
+
+class ChainProgram(object):
+    '''
+    Sequence of per-pixel functions evaluated back to back for every sample.
+    Consecutive affine stages are folded into one in float64, finalize() converts constants to dtype.
+    '''
+    def __init__(self, pixels, dtype=np.float64):
+        self.pixels = pixels
+        self.dtype = np.dtype(dtype)
+        self.pre = np.stack([np.ones(pixels), np.zeros(pixels)])
+        self.kinds = []
+        self.params = []
+        self.post = []
+        self.tables = []
+
+    def _current_affine(self):
+        if self.post:
+            return self.post[-1]
+        return self.pre
+
+    def add_affine(self, a, b):
+        a = np.broadcast_to(np.asarray(a, dtype=np.float64).ravel(), (self.pixels,))
+        b = np.broadcast_to(np.asarray(b, dtype=np.float64).ravel(), (self.pixels,))
+        affine = self._current_affine()
+        affine[1] = a*affine[1]+b
+        affine[0] = a*affine[0]
+
+    def add_stage(self, kind, params=None, tables=None):
+        self.kinds.append(kind)
+        stage_params = np.zeros((3, self.pixels))
+        if params is not None:
+            for i, item in enumerate(params):
+                stage_params[i] = item
+        self.params.append(stage_params)
+        self.tables.append(tables)
+        self.post.append(np.stack([np.ones(self.pixels), np.zeros(self.pixels)]))
+
+    def is_identity(self):
+        return not self.kinds and np.all(self.pre[0] == 1) and np.all(self.pre[1] == 0)
+
+    def finalize(self):
+        S = len(self.kinds)
+        self.kinds = np.array(self.kinds, dtype=np.int64)
+        self.pre = self.pre.astype(self.dtype)
+        self.params = np.array(self.params, dtype=self.dtype).reshape(S, 3, self.pixels)
+        self.post = np.array(self.post, dtype=self.dtype).reshape(S, 2, self.pixels)
+        used_tables = [item for item in self.tables if item is not None]
+        self.table_start = np.zeros(S, dtype=np.int64)
+        self.table_size = np.zeros(S, dtype=np.int64)
+        start = 0
+        for s, item in enumerate(self.tables):
+            if item is not None:
+                size = item[0].shape[1]
+                self.table_start[s] = start
+                self.table_size[s] = size
+                start += size
+        if used_tables:
+            self.knots = np.concatenate([item[0] for item in used_tables], axis=1).astype(self.dtype)
+            self.values = np.concatenate([item[1] for item in used_tables], axis=1).astype(self.dtype)
+            # Pad slopes so that every table occupies same columns as its knots
+            self.slopes = np.concatenate([np.pad(item[2], ((0, 0), (0, 1))) for item in used_tables],
+                                         axis=1).astype(self.dtype)
+        else:
+            self.knots = np.zeros((self.pixels, 1), dtype=self.dtype)
+            self.values = np.zeros((self.pixels, 1), dtype=self.dtype)
+            self.slopes = np.zeros((self.pixels, 1), dtype=self.dtype)
+        del self.tables
+
+    def run(self, frames, broken, out):
+        run_program(frames, self.pre, self.kinds, self.params, self.post, self.table_start, self.table_size,
+                    self.knots, self.values, self.slopes, broken, out)
+
+
+def _select(value, pixels, indices):
+    value = np.broadcast_to(np.asarray(value, dtype=np.float64).ravel(), (pixels,))
+    if indices is None:
+        return value
+    return value[indices]
+
+
+def compile_stages(stages, pixels, indices=None, dtype=np.float64):
+    '''
+    Turn stage descriptors into list of ChainProgram and models that have to be applied by themselves
+    :param pixels: number of pixels in frame
+    :param indices: compile for compact layout containing only these pixels (see AliveLayout)
+    :param dtype: floating point type of program constants
+    '''
+    segments = []
+    size = pixels if indices is None else indices.shape[0]
+    program = ChainProgram(size, dtype)
+    for stage in stages:
+        kind = stage[0]
+        if kind == "affine":
+            program.add_affine(_select(stage[1], pixels, indices), _select(stage[2], pixels, indices))
+        elif kind == "saturation":
+            program.add_stage(STAGE_SATURATION, params=[_select(item, pixels, indices) for item in stage[1]])
+        elif kind == "pileup":
+            program.add_stage(STAGE_PILEUP, params=[_select(item, pixels, indices) for item in stage[1]])
+        elif kind == "interpolative":
+            tables = stage[1]
+            if indices is not None:
+                tables = tuple(np.ascontiguousarray(item[indices]) for item in tables)
+            program.add_stage(STAGE_INTERPOLATIVE, tables=tables)
+        else:
+            if not program.is_identity():
+                program.finalize()
+                segments.append(program)
+            segments.append(stage[1])
+            program = ChainProgram(size, dtype)
+    if not program.is_identity() or not segments:
+        program.finalize()
+        segments.append(program)
+    return segments
+
+
+def run_segments(segments, pixel_data, broken, out, layout=None):
+    '''
+    Apply compiled segments to pixel_data. out is reused as the only intermediate buffer, so
+    compiled programs run in place; models without compiled stages never get input sharing memory with out.
+    When layout is given data are (T, n_alive) compact arrays; models without compiled stages
+    are applied to data expanded back to full grid.
+    '''
+    pixels = broken.shape[0]
+    src = pixel_data
+    no_broken = np.zeros(pixels, dtype=bool)
+    for index, segment in enumerate(segments):
+        last = index == len(segments)-1
+        if isinstance(segment, ChainProgram):
+            segment.run(src.reshape(-1, pixels), broken if last else no_broken, out.reshape(-1, pixels))
+        else:
+            if layout is not None:
+                layout.compress(segment.apply(layout.expand(src)), out=out)
+            else:
+                if np.shares_memory(src, out):
+                    src = src.copy()
+                segment.apply(src, out=out)
+            if last:
+                affine_frames(out.reshape(-1, pixels), 1.0, 0.0, broken, out.reshape(-1, pixels))
+        src = out
@@ -0,0 +1,348 @@
+'''
+Calibration fitting of flat fielding models for all pixels at once.
+
+Every function takes raw detector response pixel_data (T, W, H) measured for known
+reference intensity (T,) or (T, W, H) and returns model mapping raw response to reference.
+Pixels which could not be fitted are flagged as broken.
+'''
+import warnings
+
+import numpy as np
+import numba as nb
+from numba import prange
+
+from .models import Linear, NonlinearSaturation, NonlinearPileup
+from .streaming import aligned_chunk_frames
+
+KIND_SATURATION = 0
+KIND_PILEUP = 1
+N_PARAMS = 3
+
+
+def _prepare(pixel_data, reference):
+    pixel_data = np.asarray(pixel_data, dtype=np.float64)
+    pixel_shape = pixel_data.shape[-2:]
+    raw = np.ascontiguousarray(pixel_data.reshape(pixel_data.shape[0], -1))
+    reference = np.asarray(reference, dtype=np.float64)
+    if reference.ndim == 1:
+        reference = reference.reshape(-1, 1)
+    ref = np.ascontiguousarray(np.broadcast_to(reference.reshape(reference.shape[0], -1), raw.shape))
+    return raw, ref, pixel_shape
+
+
+def _linear_least_squares(raw, ref, valid):
+    '''
+    Per-pixel fit raw = slope*ref+intercept on valid samples
+    '''
+    count = valid.sum(axis=0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean_x = np.where(valid, ref, 0).sum(axis=0)/count
+        mean_y = np.where(valid, raw, 0).sum(axis=0)/count
+        dx = np.where(valid, ref-mean_x, 0)
+        dy = np.where(valid, raw-mean_y, 0)
+        slope = (dx*dy).sum(axis=0)/(dx*dx).sum(axis=0)
+        intercept = mean_y-slope*mean_x
+    return slope, intercept
+
+
+@nb.njit(parallel=True, cache=True)
+def accumulate_linear(raw, ref, count, mean_x, mean_y, m2_x, c_xy):
+    '''
+    Welford update of per-pixel means, reference variance and covariance sums
+    '''
+    T, P = raw.shape
+    for p in prange(P):
+        n = count[p]
+        mx = mean_x[p]
+        my = mean_y[p]
+        m2 = m2_x[p]
+        c = c_xy[p]
+        for t in range(T):
+            y = raw[t, p]
+            x = ref[t, p]
+            if y == y and x == x:
+                n += 1
+                dx = x-mx
+                mx += dx/n
+                my += (y-my)/n
+                m2 += dx*(x-mx)
+                c += dx*(y-my)
+        count[p] = n
+        mean_x[p] = mx
+        mean_y[p] = my
+        m2_x[p] = m2
+        c_xy[p] = c
+
+
+class LinearAccumulator(object):
+    '''
+    Streaming sufficient statistics for Linear calibration (raw = coefficient*reference+baseline).
+    Consumes data chunk by chunk with constant memory. Accumulators of different chunks, files
+    or worker processes can be merged (it is picklable).
+    Statistics are kept as counts, means and centered sums, equivalent to Σx, Σy, Σxy, Σx²
+    but without cancellation for large counts.
+    '''
+    def __init__(self, pixel_shape=(16, 16)):
+        self.pixel_shape = tuple(pixel_shape)
+        pixels = int(np.prod(self.pixel_shape))
+        self.count = np.zeros(pixels, dtype=np.int64)
+        self.mean_x = np.zeros(pixels)
+        self.mean_y = np.zeros(pixels)
+        self.m2_x = np.zeros(pixels)
+        self.c_xy = np.zeros(pixels)
+
+    def update(self, pixel_data, reference):
+        '''
+        Add (T, W, H) chunk of raw response measured at reference intensity (T,) or (T, W, H)
+        '''
+        pixel_data = np.asarray(pixel_data, dtype=np.float64)
+        raw = pixel_data.reshape(pixel_data.shape[0], -1)
+        reference = np.asarray(reference, dtype=np.float64)
+        ref = np.broadcast_to(reference.reshape(reference.shape[0], -1), raw.shape)
+        accumulate_linear(raw, ref, self.count, self.mean_x, self.mean_y, self.m2_x, self.c_xy)
+        return self
+
+    def update_stream(self, src, reference, chunk_frames=None):
+        '''
+        Add whole (T, W, H) dataset reading it in chunks aligned to its HDF5 layout
+        '''
+        chunk_frames = aligned_chunk_frames(src, chunk_frames)
+        for start in range(0, src.shape[0], chunk_frames):
+            end = min(start+chunk_frames, src.shape[0])
+            self.update(src[start:end], reference[start:end])
+        return self
+
+    def merge(self, other):
+        '''
+        Combine with statistics accumulated elsewhere (Chan et al. pairwise formulas)
+        '''
+        total = self.count+other.count
+        with np.errstate(divide="ignore", invalid="ignore"):
+            weight = np.where(total > 0, other.count/total, 0.0)
+        cross = self.count*weight
+        delta_x = other.mean_x-self.mean_x
+        delta_y = other.mean_y-self.mean_y
+        self.m2_x = self.m2_x+other.m2_x+delta_x*delta_x*cross
+        self.c_xy = self.c_xy+other.c_xy+delta_x*delta_y*cross
+        self.mean_x = self.mean_x+delta_x*weight
+        self.mean_y = self.mean_y+delta_y*weight
+        self.count = total
+        return self
+
+    def to_model(self):
+        '''
+        Linear model from accumulated statistics. Pixels with degenerate statistics are broken
+        '''
+        with np.errstate(divide="ignore", invalid="ignore"):
+            slope = self.c_xy/self.m2_x
+            intercept = self.mean_y-slope*self.mean_x
+        failed = np.logical_not(np.logical_and(np.isfinite(slope), np.isfinite(intercept)))
+        failed = np.logical_or(failed, self.count < 2)
+        coefficients = np.where(failed, 0.0, slope).reshape(self.pixel_shape)
+        baseline = np.where(failed, 0.0, intercept).reshape(self.pixel_shape)
+        model = Linear(coefficients, baseline)
+        model.set_broken(np.logical_or(failed.reshape(self.pixel_shape), model.get_broken_auto()))
+        return model
+
+
+def fit_linear(pixel_data, reference):
+    '''
+    Closed form least squares for Linear model (raw = coefficient*reference+baseline)
+    '''
+    pixel_data = np.asarray(pixel_data)
+    return LinearAccumulator(pixel_data.shape[-2:]).update(pixel_data, reference).to_model()
+
+
+@nb.njit(inline="always", cache=True)
+def _response(kind, ref, params, prescaler, jac):
+    '''
+    Raw response predicted for reference intensity, its derivatives are written to jac
+    '''
+    if kind == KIND_SATURATION:
+        # raw = A*(1-exp(-(ref-offset)*R/A))
+        saturation, response, offset = params[0], params[1], params[2]
+        u = (ref-offset)*response/saturation
+        e = np.exp(-u)
+        jac[0] = 1.0-e-e*u
+        jac[1] = e*(ref-offset)
+        jac[2] = -response*e
+        return saturation*(1.0-e)
+    else:
+        # raw = (s/p)*u*exp(-s*u/d), u = ref-offset
+        sensitivity, divider, offset = params[0], params[1], params[2]
+        u = ref-offset
+        e = np.exp(-sensitivity*u/divider)
+        g = sensitivity/prescaler*u*e
+        slope = sensitivity/prescaler*e*(1.0-sensitivity*u/divider)
+        jac[0] = u/prescaler*e*(1.0-sensitivity*u/divider)
+        jac[1] = g*sensitivity*u/(divider*divider)
+        jac[2] = -slope
+        return g
+
+
+@nb.njit(inline="always", cache=True)
+def _cost(kind, raw, ref, p, params, prescaler, jac):
+    total = 0.0
+    for t in range(raw.shape[0]):
+        y = raw[t, p]
+        x = ref[t, p]
+        if y == y and x == x:
+            r = _response(kind, x, params, prescaler, jac)-y
+            total += r*r
+    return total
+
+
+@nb.njit(inline="always", cache=True)
+def _solve3(a, b, out):
+    '''
+    Solve 3x3 system by Cramer's rule. Returns False for singular matrix
+    '''
+    det = (a[0, 0]*(a[1, 1]*a[2, 2]-a[1, 2]*a[2, 1])
+           - a[0, 1]*(a[1, 0]*a[2, 2]-a[1, 2]*a[2, 0])
+           + a[0, 2]*(a[1, 0]*a[2, 1]-a[1, 1]*a[2, 0]))
+    if det == 0.0 or det != det:
+        return False
+    for k in range(3):
+        m00 = b[0] if k == 0 else a[0, 0]
+        m10 = b[1] if k == 0 else a[1, 0]
+        m20 = b[2] if k == 0 else a[2, 0]
+        m01 = b[0] if k == 1 else a[0, 1]
+        m11 = b[1] if k == 1 else a[1, 1]
+        m21 = b[2] if k == 1 else a[2, 1]
+        m02 = b[0] if k == 2 else a[0, 2]
+        m12 = b[1] if k == 2 else a[1, 2]
+        m22 = b[2] if k == 2 else a[2, 2]
+        out[k] = (m00*(m11*m22-m12*m21)-m01*(m10*m22-m12*m20)+m02*(m10*m21-m11*m20))/det
+    return True
+
+
+@nb.njit(parallel=True, error_model="numpy", cache=True)
+def levenberg_marquardt(kind, raw, ref, params, prescaler, max_iterations, tolerance, converged):
+    '''
+    Batched Levenberg-Marquardt, one independent problem per pixel (column of raw and ref).
+    params (P, 3) hold initial guesses and are overwritten by results.
+    '''
+    P = raw.shape[1]
+    for p in prange(P):
+        jac = np.zeros(N_PARAMS)
+        jtj = np.zeros((N_PARAMS, N_PARAMS))
+        damped = np.zeros((N_PARAMS, N_PARAMS))
+        jtr = np.zeros(N_PARAMS)
+        step = np.zeros(N_PARAMS)
+        current = params[p].copy()
+        trial = np.zeros(N_PARAMS)
+        damping = 1e-3
+        cost = _cost(kind, raw, ref, p, current, prescaler, jac)
+        converged[p] = False
+        if cost != cost:
+            continue
+        for _ in range(max_iterations):
+            jtj[:, :] = 0.0
+            jtr[:] = 0.0
+            for t in range(raw.shape[0]):
+                y = raw[t, p]
+                x = ref[t, p]
+                if y == y and x == x:
+                    r = _response(kind, x, current, prescaler, jac)-y
+                    for i in range(N_PARAMS):
+                        jtr[i] += jac[i]*r
+                        for j in range(N_PARAMS):
+                            jtj[i, j] += jac[i]*jac[j]
+            improved = False
+            while damping < 1e12:
+                for i in range(N_PARAMS):
+                    for j in range(N_PARAMS):
+                        damped[i, j] = jtj[i, j]
+                    damped[i, i] += damping*(jtj[i, i]+1e-12)
+                if not _solve3(damped, jtr, step):
+                    damping *= 10.0
+                    continue
+                for i in range(N_PARAMS):
+                    trial[i] = current[i]-step[i]
+                trial_cost = _cost(kind, raw, ref, p, trial, prescaler, jac)
+                if trial_cost < cost:
+                    improved = True
+                    break
+                damping *= 10.0
+            if not improved:
+                # No descent direction left: local minimum
+                converged[p] = True
+                break
+            decrease = cost-trial_cost
+            current[:] = trial
+            cost = trial_cost
+            damping = max(damping/10.0, 1e-12)
+            if decrease <= tolerance*(cost+tolerance):
+                converged[p] = True
+                break
+        params[p] = current
+
+
+def _fit_nonlinear(kind, raw, ref, initial, prescaler, max_iterations, tolerance):
+    params = np.ascontiguousarray(initial, dtype=np.float64)
+    converged = np.zeros(raw.shape[1], dtype=bool)
+    levenberg_marquardt(kind, raw, ref, params, float(prescaler), max_iterations, tolerance, converged)
+    failed = np.logical_not(np.logical_and(converged, np.isfinite(params).all(axis=1)))
+    return params, failed
+
+
+def _low_range_line(raw, ref):
+    '''
+    Linear approximation of response in lower half of reference range for initial guesses.
+    Pixels with too few samples or without response are marked as degenerate.
+    '''
+    valid = np.logical_and(np.isfinite(raw), np.isfinite(ref))
+    with warnings.catch_warnings():
+        # Pixels without valid samples
+        warnings.simplefilter("ignore", RuntimeWarning)
+        median = np.nanmedian(np.where(valid, ref, np.nan), axis=0)
+    low = np.logical_and(valid, ref <= median)
+    slope, intercept = _linear_least_squares(raw, ref, low)
+    degenerate = np.logical_or(np.logical_not(np.isfinite(slope)), slope == 0)
+    degenerate = np.logical_or(degenerate, valid.sum(axis=0) <= N_PARAMS)
+    slope = np.where(degenerate, 1.0, slope)
+    intercept = np.where(degenerate, 0.0, intercept)
+    return slope, intercept, valid, degenerate
+
+
+def _valid_max(values, valid, default):
+    result = np.max(np.where(valid, values, -np.inf), axis=0)
+    return np.where(np.logical_and(np.isfinite(result), result > 0), result, default)
+
+
+def fit_saturation(pixel_data, reference, max_iterations=100, tolerance=1e-12):
+    '''
+    Fit NonlinearSaturation (raw = A*(1-exp(-(reference-offset)*R/A))) with batched Levenberg-Marquardt
+    '''
+    raw, ref, pixel_shape = _prepare(pixel_data, reference)
+    slope, intercept, valid, degenerate = _low_range_line(raw, ref)
+    initial = np.stack([_valid_max(raw, valid, 1.0)*1.5, slope, -intercept/slope], axis=1)
+    params, failed = _fit_nonlinear(KIND_SATURATION, raw, ref, initial, 1.0, max_iterations, tolerance)
+    failed = np.logical_or(failed, np.logical_or(degenerate, params[:, 0] <= 0))
+    params[failed] = 0.0
+    model = NonlinearSaturation(params[:, 0].reshape(pixel_shape), params[:, 1].reshape(pixel_shape),
+                                params[:, 2].reshape(pixel_shape))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        model.set_broken(np.logical_or(failed.reshape(pixel_shape), model.get_broken_auto()))
+    return model
+
+
+def fit_pileup(pixel_data, reference, prescaler=1.0, max_iterations=100, tolerance=1e-12):
+    '''
+    Fit NonlinearPileup (raw*prescaler = s*u*exp(-s*u/d), u = reference-offset)
+    with batched Levenberg-Marquardt. prescaler is fixed.
+    '''
+    raw, ref, pixel_shape = _prepare(pixel_data, reference)
+    slope, intercept, valid, degenerate = _low_range_line(raw, ref)
+    sensitivity = slope*prescaler
+    offset = -intercept/slope
+    max_u = _valid_max(ref-offset, valid, 1.0)
+    initial = np.stack([sensitivity, 2.0*np.abs(sensitivity)*max_u, offset], axis=1)
+    params, failed = _fit_nonlinear(KIND_PILEUP, raw, ref, initial, prescaler, max_iterations, tolerance)
+    failed = np.logical_or(failed, degenerate)
+    failed = np.logical_or(failed, np.logical_or(params[:, 0] <= 0, params[:, 1] == 0))
+    params[failed] = 0.0
+    model = NonlinearPileup(params[:, 0].reshape(pixel_shape), params[:, 1].reshape(pixel_shape),
+                            prescaler, params[:, 2].reshape(pixel_shape))
+    model.set_broken(np.logical_or(failed.reshape(pixel_shape), model.get_broken_auto()))
+    return model
@@ -0,0 +1,94 @@
+import numpy as np
+import numba as nb
+from numba import prange
+
+from .lambertw import lambertw0, BRANCH_POINT
+
+# Fused evaluation kernels.
+# All of them work on frames flattened to (T, P) with per-pixel constants of shape (P,),
+# apply master_coeff/master_offset and zero broken pixels in the same pass.
+
+
+@nb.njit(parallel=True, cache=True)
+def affine_frames(src, master_coeff, master_offset, broken, out):
+    T, P = src.shape
+    for t in prange(T):
+        for p in range(P):
+            if broken[p]:
+                out[t, p] = 0.0
+            else:
+                out[t, p] = master_coeff*src[t, p]+master_offset
+
+
+@nb.njit(parallel=True, cache=True)
+def apply_linear(frames, rev_coeffs, baseline, master_coeff, master_offset, broken, out):
+    T, P = frames.shape
+    for t in prange(T):
+        for p in range(P):
+            if broken[p]:
+                out[t, p] = 0.0
+            else:
+                out[t, p] = master_coeff*((frames[t, p]-baseline[p])*rev_coeffs[p])+master_offset
+
+
+@nb.njit(inline="always", cache=True)
+def saturation_value(x, inv_a, inv_b, offset):
+    arg = 1.0-x*inv_a
+    if arg <= 0:
+        return 0.0
+    return offset-np.log(arg)*inv_b
+
+
+@nb.njit(parallel=True, cache=True)
+def apply_saturation(frames, inv_a, inv_b, offset, master_coeff, master_offset, broken, out):
+    T, P = frames.shape
+    for t in prange(T):
+        for p in range(P):
+            if broken[p]:
+                out[t, p] = 0.0
+            else:
+                value = saturation_value(frames[t, p], inv_a[p], inv_b[p], offset[p])
+                out[t, p] = master_coeff*value+master_offset
+
+
+@nb.njit(inline="always", cache=True)
+def nan_to_num(x, limit):
+    '''
+    np.nan_to_num with infinities replaced by -limit/limit (maximum of result dtype)
+    '''
+    if x != x:
+        return 0.0
+    if x == np.inf:
+        return limit
+    if x == -np.inf:
+        return -limit
+    return x
+
+
+@nb.njit(inline="always", cache=True)
+def pileup_value(x, divider, scale, limit):
+    '''
+    NonlinearPileup.evaluate without offset for prescaled input. scale = -divider/sensitivity,
+    limit is maximum of result dtype
+    '''
+    if x != x or divider == 0:
+        return 0.0
+    clip = min(max(x, 0.0), divider/np.e)
+    arg = -clip/divider
+    if arg == BRANCH_POINT:
+        # scipy.special.lambertw gives NaN exactly at -1/e, original evaluation turned it to 0
+        return 0.0
+    return nan_to_num(scale*lambertw0(arg), limit)
+
+
+@nb.njit(parallel=True, cache=True)
+def apply_pileup(frames, prescaler, divider, scale, offset, master_coeff, master_offset, broken, out):
+    T, P = frames.shape
+    limit = np.finfo(out.dtype).max
+    for t in prange(T):
+        for p in range(P):
+            if broken[p]:
+                out[t, p] = 0.0
+            else:
+                value = pileup_value(frames[t, p]*prescaler[p], divider[p], scale[p], limit)+offset[p]
+                out[t, p] = master_coeff*value+master_offset
@@ -0,0 +1,69 @@
+'''
+Principal real branch of Lambert W function compiled with numba.
+Replaces scipy.special.lambertw (complex arithmetic) in pileup correction.
+'''
+import numpy as np
+import numba as nb
+
+BRANCH_POINT = -1/np.e
+HALLEY_ITERATIONS = 8
+
+
+@nb.njit(nb.float64(nb.float64), error_model="numpy", cache=True)
+def lambertw0(x):
+    '''
+    W0(x) for x >= -1/e. Values below branch point within rounding are clamped to it, other ones give NaN.
+    '''
+    if x != x:
+        return x
+    if x == 0.0:
+        return 0.0
+    if x <= BRANCH_POINT:
+        if x >= BRANCH_POINT*(1+1e-12):
+            return -1.0
+        return np.nan
+    if x == np.inf:
+        return np.inf
+    # Initial guess
+    if x < -0.32:
+        # Series around branch point
+        p = np.sqrt(2.0*(np.e*x+1.0))
+        w = -1.0+p*(1.0+p*(-1.0/3.0+p*11.0/72.0))
+    elif x < 3.0:
+        # Winitzki approximation
+        l1 = np.log1p(x)
+        w = l1*(1.0-np.log1p(l1)/(2.0+l1))
+    else:
+        l1 = np.log(x)
+        l2 = np.log(l1)
+        w = l1-l2+l2/l1
+    # Halley iterations
+    for _ in range(HALLEY_ITERATIONS):
+        ew = np.exp(w)
+        f = w*ew-x
+        wp1 = w+1.0
+        if wp1 == 0.0:
+            break
+        dw = f/(ew*wp1-(w+2.0)*f/(2.0*wp1))
+        w -= dw
+        if abs(dw) <= 1e-15*(1.0+abs(w)):
+            break
+    return w
+
+
+@nb.njit(parallel=True, cache=True)
+def lambertw0_array(x, out):
+    flat = x.ravel()
+    target = out.ravel()
+    for i in nb.prange(flat.shape[0]):
+        target[i] = lambertw0(flat[i])
+
+
+def lambertw_real(x):
+    '''
+    Vectorized W0 for real arrays
+    '''
+    x = np.ascontiguousarray(x, dtype=np.float64)
+    out = np.empty(x.shape)
+    lambertw0_array(x, out)
+    return out
@@ -0,0 +1,152 @@
+'''
+Lazy flat fielded view of raw recording.
+Frames are evaluated on demand in fixed blocks, recently used blocks are kept in small LRU.
+'''
+from collections import OrderedDict
+import numbers
+
+import numpy as np
+
+from .alive_layout import AliveLayout
+
+DEFAULT_BLOCK_FRAMES = 256
+DEFAULT_MAX_BLOCKS = 16
+
+
+class LazyView(object):
+    '''
+    Array-like (T, W, H) result of model.apply_nobreak(raw) (or apply(raw)) computed on access.
+    First index selects frames (integer, slice or integer array), the rest selects pixels.
+    Single pixel series view[:, i, j] are evaluated for that pixel only,
+    unless model uses LUT or surrogate evaluation (then they are cut from evaluated blocks).
+    raw may be numpy array, h5py dataset or anything sliceable along time axis.
+    '''
+    def __init__(self, model, raw, block_frames=DEFAULT_BLOCK_FRAMES, max_blocks=DEFAULT_MAX_BLOCKS, nobreak=True):
+        self.model = model
+        self.raw = raw
+        self.block_frames = block_frames
+        self.max_blocks = max_blocks
+        self.nobreak = nobreak
+        self._blocks = OrderedDict()
+        self._state = None
+
+    @property
+    def shape(self):
+        return tuple(self.raw.shape)
+
+    @property
+    def dtype(self):
+        return self.model.dtype
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        result = self[:]
+        if dtype is not None:
+            result = result.astype(dtype, copy=False)
+        return result
+
+    def _broken(self):
+        if self.nobreak:
+            return np.asarray(self.model.get_broken(), dtype=bool)
+        return np.zeros(self.shape[1:], dtype=bool)
+
+    def _check_state(self):
+        # Blocks are dropped when model changes
+        model = self.model
+        state = (model.parameters_stamp(), model.master_coeff, model.master_offset, model.dtype,
+                 np.packbits(self._broken()).tobytes())
+        if state != self._state:
+            self._blocks.clear()
+            self._state = state
+
+    def clear(self):
+        self._blocks.clear()
+
+    def _block(self, index):
+        block = self._blocks.get(index)
+        if block is not None:
+            self._blocks.move_to_end(index)
+            return block
+        start = index*self.block_frames
+        end = min(start+self.block_frames, self.shape[0])
+        raw = np.asarray(self.raw[start:end])
+        if self.nobreak:
+            block = self.model.apply_nobreak(raw)
+        else:
+            block = self.model.apply(raw)
+        self._blocks[index] = block
+        if len(self._blocks) > self.max_blocks:
+            self._blocks.popitem(last=False)
+        return block
+
+    def _frames(self, frames):
+        out = np.empty((frames.shape[0],)+self.shape[1:], dtype=self.dtype)
+        blocks = frames // self.block_frames
+        for index in np.unique(blocks):
+            selected = blocks == index
+            out[selected] = self._block(index)[frames[selected]-index*self.block_frames]
+        return out
+
+    def _pixel_series(self, time_key, i, j):
+        if not self.model.evaluates_exactly():
+            frames = np.arange(self.shape[0])[time_key]
+            series = self._frames(np.atleast_1d(frames))[:, i, j]
+            return series[0] if np.ndim(frames) == 0 else series
+        raw = np.asarray(self.raw[time_key, i, j])
+        scalar = raw.ndim == 0
+        layout = AliveLayout.from_indices([[i, j]], self.shape[1:])
+        broken = np.ascontiguousarray(self._broken().ravel()[layout.indices])
+        result = self.model._apply_layout(np.ascontiguousarray(raw).reshape(-1, 1), layout, broken, None)
+        return result[0, 0] if scalar else result[:, 0]
+
+    def _expand_key(self, key):
+        '''
+        Key as tuple of at most ndim items with Ellipsis replaced by full slices
+        '''
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any(item is None for item in key):
+            raise IndexError("New axes are not supported by LazyView")
+        ellipsis = [k for k, item in enumerate(key) if item is Ellipsis]
+        if len(ellipsis) > 1:
+            raise IndexError("An index can only have a single ellipsis")
+        if ellipsis:
+            k = ellipsis[0]
+            key = key[:k]+(slice(None),)*max(self.ndim-len(key)+1, 0)+key[k+1:]
+        if len(key) > self.ndim:
+            raise IndexError(f"Too many indices: view is {self.ndim}-dimensional, but {len(key)} were indexed")
+        return key
+
+    def __getitem__(self, key):
+        key = self._expand_key(key)
+        time_key = key[0]
+        pixel_key = key[1:]
+        self._check_state()
+        if (len(pixel_key) == 2 and all(isinstance(item, numbers.Integral) for item in pixel_key)
+                and isinstance(time_key, (slice, numbers.Integral))):
+            for item, size in zip(pixel_key, self.shape[1:]):
+                if not -size <= item < size:
+                    raise IndexError(f"Pixel index {item} is out of range for size {size}")
+            i, j = (item % size for item, size in zip(pixel_key, self.shape[1:]))
+            return self._pixel_series(time_key, i, j)
+        length = self.shape[0]
+        if isinstance(time_key, numbers.Integral):
+            if not -length <= time_key < length:
+                raise IndexError(f"Frame {time_key} is out of range for {length} frames")
+            frames = np.array([time_key % length])
+        elif isinstance(time_key, slice):
+            frames = np.arange(*time_key.indices(length))
+        else:
+            frames = np.arange(length)[time_key]
+        result = self._frames(np.atleast_1d(frames))
+        if isinstance(time_key, numbers.Integral):
+            result = result[0]
+        else:
+            pixel_key = (slice(None),)+pixel_key
+        return result[pixel_key]
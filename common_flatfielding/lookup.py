@@ -0,0 +1,39 @@
+'''
+Lookup table evaluation for integer (photon count) input.
+Model output for every count value 0..max_count is precomputed per pixel, evaluation is a single gather.
+'''
+import numpy as np
+import numba as nb
+from numba import prange
+
+DEFAULT_MAX_COUNT = 4095
+
+
+def build_lut(model, max_count, pixel_shape):
+    '''
+    Tabulate model.evaluate() for all counts up to max_count
+    :return: (P, max_count+1) table
+    '''
+    counts = np.arange(max_count+1, dtype=np.float64)
+    grid = np.broadcast_to(counts.reshape(-1, 1, 1), (max_count+1,)+tuple(pixel_shape))
+    table = np.asarray(model.evaluate(np.ascontiguousarray(grid)), dtype=np.float64)
+    return np.ascontiguousarray(table.reshape(max_count+1, -1).T)
+
+
+@nb.njit(parallel=True, cache=True)
+def apply_lut(frames, table, master_coeff, master_offset, broken, out, missed):
+    '''
+    Gather model output from table. Frames containing counts outside of table are marked in missed
+    '''
+    T, P = frames.shape
+    K = table.shape[1]
+    for t in prange(T):
+        for p in range(P):
+            if broken[p]:
+                out[t, p] = 0.0
+            else:
+                count = frames[t, p]
+                if 0 <= count < K:
+                    out[t, p] = master_coeff*table[p, count]+master_offset
+                else:
+                    missed[t] = True
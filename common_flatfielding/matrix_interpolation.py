@@ -2,32 +2,103 @@ import numpy as np
 import numba as nb
 from numba import prange
 
-@nb.njit(nb.float64[:,:,:](nb.float64[:,:,:],nb.float64[:,:,:],nb.float64[:]))
+# Frames are processed in blocks of this many samples per pixel.
+# Small enough for a block of (T, 256) frames to stay in cache.
+TIME_BLOCK = 256
+
+
+def build_knot_tables(xf_matrix, y_frames):
+    '''
+    Precompute per-pixel interpolation tables
+    :param xf_matrix: (K, W, H) knots
+    :param y_frames: (K,) or (K, W, H) values in knots
+    :return: knots, values (P, K) sorted by knot and slopes (P, K-1) of each segment
+    '''
+    xf_matrix = np.asarray(xf_matrix, dtype=np.float64)
+    K = xf_matrix.shape[0]
+    knots = xf_matrix.reshape(K, -1).T
+    values = np.broadcast_to(np.asarray(y_frames, dtype=np.float64).reshape(K, -1), (K, knots.shape[0])).T
+    order = np.argsort(knots, axis=1, kind="stable")
+    knots = np.ascontiguousarray(np.take_along_axis(knots, order, axis=1))
+    values = np.ascontiguousarray(np.take_along_axis(values, order, axis=1))
+    dx = np.diff(knots, axis=1)
+    slopes = np.zeros(dx.shape)
+    np.divide(np.diff(values, axis=1), dx, out=slopes, where=dx != 0)
+    return knots, values, slopes
+
+
+@nb.njit(inline="always", cache=True)
+def interpolate_segment(x, knots, values, slopes, p, start, K, k):
+    '''
+    np.interp for single value using K columns of tables row p beginning at start.
+    k is segment hint (usually segment of previous sample); returns value and found segment
+    '''
+    if x != x:
+        return x, k
+    if x < knots[p, start]:
+        return values[p, start], 0
+    if x >= knots[p, start+K-1]:
+        return values[p, start+K-1], K-2
+    if not (knots[p, start+k] <= x < knots[p, start+k+1]):
+        low = 0
+        high = K-1
+        # knots[low] <= x < knots[high]
+        while high-low > 1:
+            mid = (low+high)//2
+            if knots[p, start+mid] <= x:
+                low = mid
+            else:
+                high = mid
+        k = low
+    return values[p, start+k]+slopes[p, start+k]*(x-knots[p, start+k]), k
+
+
+@nb.njit(parallel=True, cache=True)
+def interpolate_frames(frames, knots, values, slopes, master_coeff, master_offset, broken, out):
+    T, P = frames.shape
+    K = knots.shape[1]
+    blocks = (T+TIME_BLOCK-1)//TIME_BLOCK
+    for job in prange(blocks*P):
+        block = job // P
+        p = job % P
+        start = block*TIME_BLOCK
+        end = min(start+TIME_BLOCK, T)
+        if broken[p]:
+            for t in range(start, end):
+                out[t, p] = 0.0
+        elif K == 1:
+            for t in range(start, end):
+                out[t, p] = master_coeff*values[p, 0]+master_offset
+        else:
+            k = 0
+            for t in range(start, end):
+                value, k = interpolate_segment(frames[t, p], knots, values, slopes, p, 0, K, k)
+                out[t, p] = master_coeff*value+master_offset
+
+
+def interpolate_tables(x_arr, tables, out=None):
+    '''
+    Interpolate (..., W, H) array using precomputed tables from build_knot_tables.
+    Result has common floating point type of input and tables (float32 input with float32 tables stays float32)
+    '''
+    x_arr = np.asarray(x_arr)
+    if out is None:
+        out = np.empty(x_arr.shape, dtype=np.result_type(x_arr.dtype, tables[1].dtype))
+    P = x_arr.shape[-2]*x_arr.shape[-1]
+    interpolate_frames(x_arr.reshape(-1, P), *tables, 1.0, 0.0, np.zeros(P, dtype=bool), out.reshape(-1, P))
+    return out
+
+
 def interpolate_matrix_3d(x_arr, xf_matrix, y_frames):
-    T, W, H = x_arr.shape
-    result = np.zeros(shape=(T,W,H))
-    for i in range(W):
-        for j in range(H):
-            x = x_arr[:,i,j]
-            xf = xf_matrix[:,i,j]
-            yf = y_frames
-            result[:,i,j] = np.interp(x,xf,yf)
-    return result
-
-@nb.njit(nb.float64[:,:](nb.float64[:,:],nb.float64[:,:,:],nb.float64[:]))
+    return interpolate_tables(x_arr, build_knot_tables(xf_matrix, y_frames))
+
+
 def interpolate_matrix_2d(x_arr, xf_matrix, y_frames):
-    W, H = x_arr.shape
-    result = np.zeros(shape=(W,H))
-    for i in range(W):
-        for j in range(H):
-            x = x_arr[i,j]
-            xf = xf_matrix[:,i,j]
-            yf = y_frames
-            result[i,j] = np.interp(x,xf,yf)
-    return result
+    return interpolate_tables(x_arr, build_knot_tables(xf_matrix, y_frames))
+
 
 def interpolate_matrix(x_arr, xf_matrix, y_frames):
     if len(x_arr.shape)==3:
         return interpolate_matrix_3d(x_arr, xf_matrix, y_frames)
     else:
-        return interpolate_matrix_2d(x_arr, xf_matrix, y_frames)
\ No newline at end of file
+        return interpolate_matrix_2d(x_arr, xf_matrix, y_frames)
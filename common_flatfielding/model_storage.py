@@ -0,0 +1,95 @@
+'''
+Binary (HDF5) container for flat fielding models.
+
+Layout mirrors FlatFieldingModel.dump(raw=True):
+arrays are stored as contiguous datasets, scalars and strings as attributes,
+nested dictionaries as groups and lists of dictionaries (Chain models) as groups with numbered members.
+'''
+import os
+
+import h5py
+import numpy as np
+
+HDF5_SIGNATURE = b"\x89HDF\r\n\x1a\n"
+LIST_MARKER = "__list__"
+# Arrays smaller than this are read into memory even when memory mapping is requested
+MMAP_THRESHOLD_BYTES = 1 << 16
+
+
+def is_binary(file_path):
+    with open(file_path, "rb") as fp:
+        return fp.read(len(HDF5_SIGNATURE)) == HDF5_SIGNATURE
+
+
+def _is_dict_list(value):
+    return isinstance(value, (list, tuple)) and len(value) > 0 and all(isinstance(item, dict) for item in value)
+
+
+def _write_group(group, data):
+    for key, value in data.items():
+        if isinstance(value, dict):
+            _write_group(group.create_group(key), value)
+        elif _is_dict_list(value):
+            subgroup = group.create_group(key)
+            subgroup.attrs[LIST_MARKER] = True
+            for i, item in enumerate(value):
+                _write_group(subgroup.create_group(str(i)), item)
+        elif isinstance(value, (np.ndarray, list, tuple)):
+            group.create_dataset(key, data=np.asarray(value))
+        elif value is None:
+            group.attrs[key] = h5py.Empty("f8")
+        else:
+            group.attrs[key] = value
+
+
+def _read_dataset(dataset, mmap):
+    if mmap and dataset.nbytes >= MMAP_THRESHOLD_BYTES and dataset.chunks is None:
+        offset = dataset.id.get_offset()
+        if offset is not None:
+            return np.memmap(dataset.file.filename, dtype=dataset.dtype, mode="c",
+                             offset=offset, shape=dataset.shape)
+    return dataset[()]
+
+
+def _read_attribute(value):
+    if isinstance(value, h5py.Empty):
+        return None
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def _read_group(group, mmap):
+    result = {key: _read_attribute(value) for key, value in group.attrs.items() if key != LIST_MARKER}
+    for key, item in group.items():
+        if isinstance(item, h5py.Dataset):
+            result[key] = _read_dataset(item, mmap)
+        elif item.attrs.get(LIST_MARKER, False):
+            result[key] = [_read_group(item[str(i)], mmap) for i in range(len(item))]
+        else:
+            result[key] = _read_group(item, mmap)
+    return result
+
+
+def save_binary(save_data, file_path):
+    '''
+    Write raw model dump to HDF5 file.
+    File is written next to target and renamed, so a model memory mapped from file_path stays valid
+    '''
+    temp_path = file_path+".tmp"
+    try:
+        with h5py.File(temp_path, "w") as fp:
+            _write_group(fp, save_data)
+        os.replace(temp_path, file_path)
+    finally:
+        if os.path.isfile(temp_path):
+            os.remove(temp_path)
+
+
+def load_binary(file_path, mmap=True):
+    '''
+    Read raw model dump from HDF5 file.
+    :param mmap: large arrays become copy-on-write memory maps and are read lazily
+    '''
+    with h5py.File(file_path, "r") as fp:
+        return _read_group(fp, mmap)
@@ -1,13 +1,61 @@
 import numpy as np
 import json
 
-from scipy.special import lambertw
-from .matrix_interpolation import interpolate_matrix
+from .matrix_interpolation import build_knot_tables, interpolate_tables, interpolate_frames
+from .kernels import affine_frames, apply_linear, apply_saturation, apply_pileup
+from .chain_compiler import compile_stages, run_segments, STAGE_SATURATION, STAGE_PILEUP
+from .streaming import apply_stream
+from .lookup import DEFAULT_MAX_COUNT, build_lut, apply_lut
+from .alive_layout import AliveLayout, pixel_indices
+from .lazy_view import LazyView, DEFAULT_BLOCK_FRAMES, DEFAULT_MAX_BLOCKS
+from .surrogate import PolynomialSurrogate, DEFAULT_TOLERANCE, DEFAULT_SEGMENTS, DEFAULT_DEGREE
+
+
+BINARY_EXTENSIONS = (".h5", ".hdf5", ".hdf")
+
+
+def to_json_compatible(data):
+    if isinstance(data, dict):
+        return {key: to_json_compatible(value) for key, value in data.items()}
+    if isinstance(data, (list, tuple)):
+        return [to_json_compatible(item) for item in data]
+    if isinstance(data, (np.ndarray, np.generic)):
+        return data.tolist()
+    return data
+
+
+def flat_frames(data):
+    '''
+    View (or copy for non-contiguous data) of (..., W, H) array as (T, W*H) frames
+    '''
+    return data.reshape(-1, data.shape[-2]*data.shape[-1])
+
+
+def per_pixel(value, shape):
+    '''
+    Contiguous flattened float64 copy of a per-pixel parameter (scalars are broadcast)
+    '''
+    return np.ascontiguousarray(np.broadcast_to(np.asarray(value, dtype=np.float64), shape)).ravel()
+
 
 class FlatFieldingModel(object):
     subclass_dict = None
+    # Attributes holding model parameters. Assigning any of them drops precomputed kernel constants.
+    PARAMETERS = ()
 
     def __init__(self):
+        self._cache = dict()
+        self._version = 0
+        # Upper count of integer lookup table, None disables LUT evaluation
+        self.lut_max_count = None
+        # Keep last evaluate() result so changes of master_coeff/master_offset need only affine update
+        self.evaluation_cache = False
+        # Input range and accuracy of polynomial surrogate, None evaluates model exactly
+        self.surrogate_settings = None
+        # ResultCache shared between models, None disables result caching
+        self.result_cache = None
+        # Floating point type of apply() results and of precomputed constants
+        self.dtype = np.dtype(np.float64)
         self.broken_pixels = None
         self.master_coeff = 1.0
         self.master_offset = 0.0
@@ -15,9 +63,263 @@ class FlatFieldingModel(object):
     def __str__(self):
         return type(self).__name__
 
-    def apply(self, pixel_data):
-        return self.master_coeff*self.evaluate(pixel_data)+self.master_offset
-        #raise NotImplementedError("How do I apply parameters?")
+    def __setattr__(self, key, value):
+        super().__setattr__(key, value)
+        if key in self.PARAMETERS and "_cache" in self.__dict__:
+            self.invalidate()
+
+    def invalidate(self):
+        '''
+        Drop everything precomputed from model parameters.
+        Must be called manually after modifying parameter arrays in place.
+        '''
+        self._version += 1
+        self._cache.clear()
+
+    def parameters_stamp(self):
+        return self._version
+
+    def set_dtype(self, dtype):
+        '''
+        Compute apply() in given floating point type. float32 halves memory and bandwidth,
+        results of float64 input are stored as float32 as well.
+        '''
+        dtype = np.dtype(dtype)
+        if not np.issubdtype(dtype, np.floating):
+            raise ValueError(f"Floating point type expected, got {dtype}")
+        self.dtype = dtype
+        self.invalidate()
+
+    def _scalar(self, value):
+        return self.dtype.type(value)
+
+    def kernel_constants(self):
+        '''
+        Precomputed per-pixel constants of fused kernel in model dtype
+        '''
+        return self._cached("kernel", lambda: tuple(np.asarray(item, dtype=self.dtype)
+                                                    for item in self._kernel_constants()))
+
+    def _kernel_constants(self):
+        raise NotImplementedError("Model has no fused kernel")
+
+    def _cached(self, name, builder):
+        stamp = self.parameters_stamp()
+        item = self._cache.get(name)
+        if item is None or item[0] != stamp:
+            item = (stamp, builder())
+            self._cache[name] = item
+        return item[1]
+
+    def apply(self, pixel_data, out=None):
+        return self._apply(pixel_data, None, out)
+
+    def _apply(self, pixel_data, broken, out):
+        pixel_data = np.asarray(pixel_data)
+        if out is None:
+            out = np.empty(pixel_data.shape, dtype=self.dtype)
+        elif out.shape != pixel_data.shape or not out.flags.c_contiguous:
+            raise ValueError("out must be a C-contiguous array with the same shape as pixel data")
+        if broken is None:
+            broken = np.zeros(pixel_data.shape[-2]*pixel_data.shape[-1], dtype=bool)
+        else:
+            broken = np.ascontiguousarray(broken, dtype=bool).ravel()
+        if self.result_cache is not None:
+            key = self.result_cache.key(self, pixel_data, broken)
+            cached = self.result_cache.get(key)
+            if cached is not None:
+                np.copyto(out, cached)
+                return out
+        if self.evaluation_cache:
+            affine_frames(flat_frames(self.cached_evaluation(pixel_data)), self._scalar(self.master_coeff),
+                          self._scalar(self.master_offset), broken, flat_frames(out))
+        elif self.lut_max_count is not None and np.issubdtype(pixel_data.dtype, np.integer):
+            self._apply_lut(pixel_data, broken, out)
+        elif self.surrogate_settings is not None:
+            self.surrogate().apply(flat_frames(pixel_data), self._scalar(self.master_coeff),
+                                   self._scalar(self.master_offset), broken, flat_frames(out))
+        else:
+            self._apply_fused(pixel_data, broken, out)
+        if self.result_cache is not None:
+            self.result_cache.put(key, out)
+        return out
+
+    def enable_result_cache(self, cache=None):
+        '''
+        Reuse apply() results for equal model and input (content addressed, see result_cache.py).
+        :param cache: ResultCache, process-wide default cache is used if not given
+        '''
+        if cache is None:
+            from .result_cache import default_cache
+            cache = default_cache()
+        self.result_cache = cache
+
+    def disable_result_cache(self):
+        self.result_cache = None
+
+    def enable_evaluation_cache(self):
+        '''
+        Remember evaluate() result for the last input array.
+        Repeated apply() on the same array only rescales it with master_coeff and master_offset.
+        Cache is dropped when model parameters change. Call drop_evaluation_cache() after modifying input in place.
+        '''
+        self.evaluation_cache = True
+
+    def disable_evaluation_cache(self):
+        self.evaluation_cache = False
+        self.drop_evaluation_cache()
+
+    def drop_evaluation_cache(self):
+        self._cache.pop("evaluation", None)
+
+    def cached_evaluation(self, pixel_data):
+        stamp = self.parameters_stamp()
+        interface = pixel_data.__array_interface__
+        key = (interface["data"][0], pixel_data.shape, pixel_data.strides, pixel_data.dtype)
+        entry = self._cache.get("evaluation")
+        # Reference to input is kept in entry so its identity can not be reused by another array
+        if entry is None or entry[0] != stamp or entry[1] is not pixel_data or entry[2] != key:
+            evaluated = np.ascontiguousarray(self.evaluate(pixel_data), dtype=self.dtype)
+            entry = (stamp, pixel_data, key, evaluated)
+            self._cache["evaluation"] = entry
+        return entry[3]
+
+    def enable_lut(self, max_count=DEFAULT_MAX_COUNT):
+        '''
+        Evaluate integer input using per-pixel lookup table for counts 0..max_count.
+        Counts outside of table are evaluated analytically.
+        '''
+        self.lut_max_count = max_count
+
+    def disable_lut(self):
+        self.lut_max_count = None
+
+    def lookup_table(self, pixel_shape):
+        tables = self._cached("lut", dict)
+        key = (self.lut_max_count, tuple(pixel_shape))
+        if key not in tables:
+            tables.clear()
+            tables[key] = build_lut(self, self.lut_max_count, pixel_shape).astype(self.dtype, copy=False)
+        return tables[key]
+
+    def _apply_lut(self, pixel_data, broken, out):
+        frames = flat_frames(pixel_data)
+        target = flat_frames(out)
+        missed = np.zeros(frames.shape[0], dtype=bool)
+        apply_lut(frames, self.lookup_table(pixel_data.shape[-2:]), self._scalar(self.master_coeff),
+                  self._scalar(self.master_offset), broken, target, missed)
+        if missed.any():
+            missed_frames = np.flatnonzero(missed)
+            fallback = np.empty((missed_frames.shape[0],)+pixel_data.shape[-2:], dtype=out.dtype)
+            self._apply_fused(frames[missed_frames].reshape(fallback.shape), broken, fallback)
+            target[missed_frames] = flat_frames(fallback)
+
+    def enable_surrogate(self, low, high, tolerance=DEFAULT_TOLERANCE, segments=DEFAULT_SEGMENTS,
+                         degree=DEFAULT_DEGREE):
+        '''
+        Evaluate apply() with piecewise polynomial approximation of the model (see surrogate.py).
+        Input outside of [low, high] and segments failing tolerance are evaluated exactly.
+        :param low: per-pixel lower bound of input range (see surrogate.observed_range())
+        :param high: per-pixel upper bound of input range
+        :param tolerance: maximum |surrogate-exact|/(1+|exact|) on verification grid
+        :param segments: segments per pixel range
+        :param degree: polynomial degree in every segment
+        '''
+        self._surrogate_parameters()
+        self.surrogate_settings = (low, high, tolerance, segments, degree)
+        self._cache.pop("surrogate", None)
+
+    def disable_surrogate(self):
+        self.surrogate_settings = None
+        self._cache.pop("surrogate", None)
+
+    def surrogate(self):
+        '''
+        PolynomialSurrogate fitted for current parameters and surrogate settings
+        '''
+        return self._cached("surrogate", lambda: PolynomialSurrogate(*self._surrogate_parameters(),
+                                                                     *self.surrogate_settings))
+
+    def _surrogate_parameters(self):
+        raise NotImplementedError("Model has no surrogate evaluation")
+
+    def evaluation_mode(self):
+        '''
+        Settings selecting alternative (possibly approximate) apply() paths, part of result cache key
+        '''
+        return [self.lut_max_count, self.surrogate_settings]
+
+    def evaluates_exactly(self):
+        '''
+        True when apply() is computed by compiled evaluation, as apply_compact() and evaluate_pixels() are.
+        LUT and surrogate evaluation work on full frames only
+        '''
+        return self.lut_max_count is None and self.surrogate_settings is None
+
+    def _apply_fused(self, pixel_data, broken, out):
+        '''
+        Evaluate model, apply master coefficient and offset and zero broken pixels writing into out.
+        Models without compiled kernel fall back to evaluate()
+        :param broken: flattened broken pixels mask
+        '''
+        evaluated = np.asarray(self.evaluate(pixel_data))
+        affine_frames(flat_frames(evaluated), self._scalar(self.master_coeff), self._scalar(self.master_offset),
+                      broken, flat_frames(out))
+
+    def _apply_stages(self):
+        '''
+        Describe apply() as stages for Chain compiler (see chain_compiler.py)
+        '''
+        return [("model", self)]
+
+    def compiled_segments(self, pixels, layout=None):
+        '''
+        apply() compiled for frames of given pixel count or for compact layout.
+        Cached until model (or any of submodels) changes.
+        '''
+        segments = self._cached("program", dict)
+        key = (pixels, None if layout is None else layout.key, self.master_coeff, self.master_offset)
+        if key not in segments:
+            if len(segments) > 4:
+                segments.clear()
+            indices = None if layout is None else layout.indices
+            segments[key] = compile_stages(self._apply_stages(), pixels, indices, self.dtype)
+        return segments[key]
+
+    def alive_layout(self):
+        '''
+        Compact layout skipping broken pixels of this model
+        '''
+        return AliveLayout(self.get_broken())
+
+    def apply_compact(self, compact, layout, out=None):
+        '''
+        apply() for (T, n_alive) data in compact layout. Broken pixels are not evaluated at all.
+        Use layout.expand() to get (T, W, H) frames back.
+        '''
+        return self._apply_layout(compact, layout, np.zeros(layout.n_alive, dtype=bool), out)
+
+    def _apply_layout(self, compact, layout, broken, out):
+        compact = np.asarray(compact)
+        if out is None:
+            out = np.empty(compact.shape, dtype=self.dtype)
+        elif out.shape != compact.shape or not out.flags.c_contiguous:
+            raise ValueError("out must be a C-contiguous array with the same shape as compact data")
+        segments = self.compiled_segments(layout.pixels, layout)
+        run_segments(segments, compact, broken, out, layout)
+        return out
+
+    def evaluate_pixels(self, pixel_data, indices):
+        '''
+        Vectorized apply_single_nobreak() for several pixels at once
+        :param pixel_data: (T, W, H) frames
+        :param indices: (N, 2) list of pixel (i, j) or (W, H) boolean mask
+        :return: (T, N) time series of requested pixels, zeros for broken ones
+        '''
+        pixel_data = np.asarray(pixel_data)
+        layout = AliveLayout.from_indices(indices, pixel_data.shape[-2:])
+        broken = np.ascontiguousarray(np.asarray(self.get_broken(), dtype=bool).ravel()[layout.indices])
+        return self._apply_layout(layout.compress(pixel_data), layout, broken, None)
 
     def apply_single(self, pixel_data, i, j):
         return self.master_coeff*self.evaluate_single(pixel_data,i,j)+self.master_offset
@@ -50,9 +352,18 @@ class FlatFieldingModel(object):
     def is_broken(self, i, j):
         return self.get_broken()[i, j]
 
-    def get_data(self):
+    def get_parameters(self):
+        '''
+        Model parameters as arrays and scalars (nested models are raw dumps)
+        '''
         return dict()
 
+    def get_data(self):
+        '''
+        Model parameters converted for JSON
+        '''
+        return to_json_compatible(self.get_parameters())
+
     def set_data(self, x_data):
         pass
 
@@ -62,12 +373,22 @@ class FlatFieldingModel(object):
     def display_parameter_2(self):
         return "tool_flatfielder.nothing", None
 
-    def save(self, file_path, override_mcoeff=None, override_offset=None):
+    def save(self, file_path, override_mcoeff=None, override_offset=None, binary=None):
+        '''
+        Save model to JSON or to binary HDF5 container.
+        :param binary: use HDF5. By default chosen by file extension (.h5, .hdf5, .hdf)
+        '''
+        if binary is None:
+            binary = file_path.lower().endswith(BINARY_EXTENSIONS)
+        if binary:
+            from .model_storage import save_binary
+            save_binary(self.dump(override_mcoeff, override_offset, raw=True), file_path)
+            return
         save_data = self.dump(override_mcoeff, override_offset)
         with open(file_path, "w") as fp:
             json.dump(save_data, fp, indent=4, sort_keys=True)
 
-    def dump(self, override_mcoeff=None, override_offset=None):
+    def dump(self, override_mcoeff=None, override_offset=None, raw=False):
         class_name = type(self).__name__
         if override_mcoeff is None:
             mcoeff = self.master_coeff
@@ -77,19 +398,34 @@ class FlatFieldingModel(object):
             moff = self.master_offset
         else:
             moff = override_offset
+        if raw:
+            parameters = self.get_parameters()
+        else:
+            parameters = self.get_data()
         save_data = {
             "model": class_name,
-            "parameters": self.get_data(),
+            "parameters": parameters,
             "master_coeff": mcoeff,
             "master_offset": moff
         }
         return save_data
 
-    def apply_nobreak(self, pixel_data):
-        pre_res = self.apply(pixel_data)
-        broken = self.get_broken()
-        pre_res[:, broken] = 0
-        return pre_res
+    def apply_nobreak(self, pixel_data, out=None):
+        return self._apply(pixel_data, self.get_broken(), out)
+
+    def apply_stream(self, src, dst, chunk_frames=None, nobreak=True, progress=None):
+        '''
+        Apply model to (T, W, H) dataset chunk by chunk writing results to dst.
+        See streaming.apply_stream()
+        '''
+        return apply_stream(self, src, dst, chunk_frames, nobreak, progress)
+
+    def lazy(self, raw, block_frames=DEFAULT_BLOCK_FRAMES, max_blocks=DEFAULT_MAX_BLOCKS, nobreak=True):
+        '''
+        Array-like view of apply_nobreak(raw) (apply(raw) if nobreak is False) evaluated on access.
+        See lazy_view.LazyView
+        '''
+        return LazyView(self, raw, block_frames, max_blocks, nobreak)
 
     def apply_single_nobreak(self, pixel_data, i, j):
         if self.is_broken(i, j):
@@ -99,9 +435,17 @@ class FlatFieldingModel(object):
 
 
     @staticmethod
-    def load(file_path):
-        with open(file_path, "r") as fp:
-            jsd = json.load(fp)
+    def load(file_path, mmap=True):
+        '''
+        Load model saved either as JSON or as binary container (detected by file signature)
+        :param mmap: memory map large arrays of binary container instead of reading them
+        '''
+        from .model_storage import is_binary, load_binary
+        if is_binary(file_path):
+            jsd = load_binary(file_path, mmap)
+        else:
+            with open(file_path, "r") as fp:
+                jsd = json.load(fp)
         instance = FlatFieldingModel.create_from_parameters(jsd)
         return instance
 
@@ -119,6 +463,8 @@ class FlatFieldingModel(object):
         return instance
 
 class Linear(FlatFieldingModel):
+    PARAMETERS = ("coefficients", "baseline")
+
     def __init__(self, coefficients=None, baseline=None):
         super().__init__()
         self.coefficients = coefficients
@@ -134,6 +480,22 @@ class Linear(FlatFieldingModel):
         ret_data = (pixel_data - self.baseline) * rev_coeffs
         return ret_data
 
+    def _kernel_constants(self):
+        shape = self.coefficients.shape
+        coefficients = per_pixel(self.coefficients, shape)
+        rev_coeffs = np.zeros(coefficients.shape)
+        np.divide(1, coefficients, out=rev_coeffs, where=coefficients != 0)
+        return rev_coeffs, per_pixel(self.baseline, shape)
+
+    def _apply_fused(self, pixel_data, broken, out):
+        rev_coeffs, baseline = self.kernel_constants()
+        apply_linear(flat_frames(pixel_data), rev_coeffs, baseline,
+                     self._scalar(self.master_coeff), self._scalar(self.master_offset), broken, flat_frames(out))
+
+    def _apply_stages(self):
+        rev_coeffs, baseline = self.kernel_constants()
+        return [("affine", rev_coeffs, -rev_coeffs*baseline), ("affine", self.master_coeff, self.master_offset)]
+
     def evaluate_single(self, single_data, i, j):
         if self.coefficients[i, j] == 0:
             rev_coeff = 0
@@ -142,18 +504,18 @@ class Linear(FlatFieldingModel):
         ret_data = (single_data - self.baseline[i, j]) * rev_coeff
         return ret_data
 
-    def get_data(self):
+    def get_parameters(self):
         self.get_broken()
         return {
-            "coefficients": self.coefficients.tolist(),
-            "baseline": self.baseline.tolist(),
-            "broken": self.broken_pixels.tolist()
+            "coefficients": self.coefficients,
+            "baseline": self.baseline,
+            "broken": self.broken_pixels
         }
 
     def set_data(self, x_data):
-        self.coefficients = np.array(x_data["coefficients"])
-        self.baseline = np.array(x_data["baseline"])
-        self.set_broken(np.array(x_data["broken"]))
+        self.coefficients = np.asarray(x_data["coefficients"])
+        self.baseline = np.asarray(x_data["baseline"])
+        self.set_broken(np.asarray(x_data["broken"]))
 
     def display_parameter_1(self):
         return "flatfielder.coefficients.title", self.coefficients
@@ -163,26 +525,28 @@ class Linear(FlatFieldingModel):
 
 
 class NonlinearSaturation(FlatFieldingModel):
+    PARAMETERS = ("saturation", "response", "offset")
+
     def __init__(self, saturation=None, response=None, offset=None):
         super().__init__()
         self.saturation = saturation
         self.response = response
         self.offset = offset
 
-    def get_data(self):
+    def get_parameters(self):
         self.get_broken()
         return {
-            "saturation": self.saturation.tolist(),
-            "response": self.response.tolist(),
-            "offset": self.offset.tolist(),
-            "broken": self.broken_pixels.tolist()
+            "saturation": self.saturation,
+            "response": self.response,
+            "offset": self.offset,
+            "broken": self.broken_pixels
         }
 
     def set_data(self, x_data):
-        self.saturation = np.array(x_data["saturation"])
-        self.response = np.array(x_data["response"])
-        self.broken_pixels = np.array(x_data["broken"])
-        self.offset = np.array(x_data["offset"])
+        self.saturation = np.asarray(x_data["saturation"])
+        self.response = np.asarray(x_data["response"])
+        self.broken_pixels = np.asarray(x_data["broken"])
+        self.offset = np.asarray(x_data["offset"])
 
     def display_parameter_1(self):
         return "flatfielder.saturation.title", self.saturation
@@ -200,6 +564,29 @@ class NonlinearSaturation(FlatFieldingModel):
         ret[(1-(pixel_data)*inv_A)<=0] = 0
         return ret
 
+    def _kernel_constants(self):
+        shape = self.saturation.shape
+        saturation = per_pixel(self.saturation, shape)
+        response = per_pixel(self.response, shape)
+        inv_a = np.zeros(saturation.shape)
+        np.divide(1, saturation, out=inv_a, where=saturation != 0)
+        inv_b = np.zeros(saturation.shape)
+        np.divide(saturation, response, out=inv_b, where=np.logical_and(saturation != 0, response != 0))
+        return inv_a, inv_b, per_pixel(self.offset, shape)
+
+    def _apply_fused(self, pixel_data, broken, out):
+        inv_a, inv_b, offset = self.kernel_constants()
+        apply_saturation(flat_frames(pixel_data), inv_a, inv_b, offset,
+                         self._scalar(self.master_coeff), self._scalar(self.master_offset), broken, flat_frames(out))
+
+    def _surrogate_parameters(self):
+        inv_a, inv_b, offset = self._kernel_constants()
+        return STAGE_SATURATION, np.stack([inv_a, inv_b, offset, np.ones(offset.shape)])
+
+    def _apply_stages(self):
+        return [("saturation", self.kernel_constants()),
+                ("affine", self.master_coeff, self.master_offset)]
+
     def evaluate_single(self, single_data,i,j):
         A = self.saturation[i,j]
         B = self.response[i,j]/self.saturation[i,j]
@@ -220,6 +607,8 @@ class NonlinearSaturation(FlatFieldingModel):
 
 
 class NonlinearPileup(FlatFieldingModel):
+    PARAMETERS = ("sensitivity", "divider", "prescaler", "offset")
+
     def __init__(self, sensitivity=None, divider=None, prescaler=None, offset=None):
         super().__init__()
         self.sensitivity = sensitivity
@@ -227,29 +616,27 @@ class NonlinearPileup(FlatFieldingModel):
         self.prescaler = prescaler
         self.offset = offset
 
-    def get_data(self):
+    def get_parameters(self):
         self.get_broken()
         if self.offset is None:
             off = 0.0
-        elif isinstance(self.offset, float):
-            off = self.offset
         else:
-            off = self.offset.tolist()
+            off = self.offset
         return {
-            "sensitivity": self.sensitivity.tolist(),
-            "divider": self.divider.tolist(),
+            "sensitivity": self.sensitivity,
+            "divider": self.divider,
             "prescaler": self.prescaler,
-            "broken": self.broken_pixels.tolist(),
+            "broken": self.broken_pixels,
             "offset": off
         }
 
     def set_data(self, x_data):
-        self.sensitivity = np.array(x_data["sensitivity"])
-        self.divider = np.array(x_data["divider"])
-        self.broken_pixels = np.array(x_data["broken"])
+        self.sensitivity = np.asarray(x_data["sensitivity"])
+        self.divider = np.asarray(x_data["divider"])
+        self.broken_pixels = np.asarray(x_data["broken"])
         self.prescaler = x_data["prescaler"]
         if "offset" in x_data.keys():
-            self.offset = np.array(x_data["offset"])
+            self.offset = np.asarray(x_data["offset"])
         else:
             self.offset = np.zeros(self.divider.shape)
 
@@ -259,29 +646,55 @@ class NonlinearPileup(FlatFieldingModel):
     def display_parameter_2(self):
         return "flatfielder.divider.title", self.divider
 
+    def _kernel_constants(self):
+        shape = self.divider.shape
+        divider = per_pixel(self.divider, shape)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            scale = -divider/per_pixel(self.sensitivity, shape)
+        offset = 0.0 if self.offset is None else self.offset
+        return per_pixel(self.prescaler, shape), divider, scale, per_pixel(offset, shape)
+
     def evaluate(self, pixel_data_in):
-        pixel_data = pixel_data_in*self.prescaler
-        upper_clamp = self.divider / np.e
-        pixels_clip = np.clip(pixel_data, a_min=0, a_max=upper_clamp)
-        pre = -self.divider / self.sensitivity * lambertw(-pixels_clip / self.divider).real
-        pre = np.nan_to_num(pre)
-        return pre+self.offset
+        pixel_data_in = np.asarray(pixel_data_in)
+        prescaler, divider, scale, offset = self.kernel_constants()
+        out = np.empty(pixel_data_in.shape, dtype=self.dtype)
+        apply_pileup(flat_frames(pixel_data_in), prescaler, divider, scale, offset,
+                     1.0, 0.0, np.zeros(divider.shape, dtype=bool), flat_frames(out))
+        return out
 
     def evaluate_single(self, single_data_in, i, j):
-        single_data = single_data_in*self.prescaler
-        divider = self.divider[i, j]
-        sens = self.sensitivity[i, j]
-        upper_clamp = divider / np.e
-        clip = np.clip(single_data, a_min=0, a_max=upper_clamp)
-        pre = -divider / sens * lambertw(-clip / divider, 0).real
-        pre = np.nan_to_num(pre)
-        return pre+self.offset[i,j]
+        prescaler, divider, scale, offset = self.kernel_constants()
+        p = np.ravel_multi_index((i, j), self.divider.shape)
+        single_data_in = np.asarray(single_data_in)
+        out = np.empty(single_data_in.shape, dtype=self.dtype)
+        apply_pileup(single_data_in.reshape(-1, 1), prescaler[p:p+1], divider[p:p+1], scale[p:p+1], offset[p:p+1],
+                     1.0, 0.0, np.zeros(1, dtype=bool), out.reshape(-1, 1))
+        return out
+
+    def _apply_fused(self, pixel_data, broken, out):
+        prescaler, divider, scale, offset = self.kernel_constants()
+        apply_pileup(flat_frames(pixel_data), prescaler, divider, scale, offset,
+                     self._scalar(self.master_coeff), self._scalar(self.master_offset), broken, flat_frames(out))
+
+    def _surrogate_parameters(self):
+        prescaler, divider, scale, offset = self._kernel_constants()
+        return STAGE_PILEUP, np.stack([divider, scale, offset, prescaler])
+
+    def _apply_stages(self):
+        prescaler, divider, scale, offset = self.kernel_constants()
+        return [("affine", prescaler, 0.0), ("pileup", (divider, scale)), ("affine", 1.0, offset),
+                ("affine", self.master_coeff, self.master_offset)]
 
     def get_broken_auto(self):
         return np.logical_or(self.sensitivity <= 0, self.divider == 0)
 
 
 class Chain(FlatFieldingModel):
+    PARAMETERS = ("models",)
+    # Evaluate apply() with stages compiled into single pass (True) or model by model (False).
+    # None chooses by contents: single pass is slower than model by model with two or more nonlinear stages
+    fused = None
+
     def __init__(self, models=None):
         super().__init__()
         if models:
@@ -297,6 +710,7 @@ class Chain(FlatFieldingModel):
     def append_model(self, model):
         print("APPENDED", model)
         self.models.append(model)
+        self.invalidate()
 
     def amend_model(self, model):
         '''
@@ -305,17 +719,54 @@ class Chain(FlatFieldingModel):
         '''
         if self.models:
             self.models[-1] = model
+            self.invalidate()
 
-    def get_data(self):
+    def get_parameters(self):
         self.get_broken()
         return {
-            "models": [item.dump() for item in self.models],
-            "broken": self.broken_pixels.tolist()
+            "models": [item.dump(raw=True) for item in self.models],
+            "broken": self.broken_pixels
         }
 
     def set_data(self, x_data):
         self.models = [self.create_from_parameters(item) for item in x_data["models"]]
-        self.broken_pixels = np.array(x_data["broken"])
+        self.broken_pixels = np.asarray(x_data["broken"])
+
+    def set_dtype(self, dtype):
+        super().set_dtype(dtype)
+        for model in self.models:
+            model.set_dtype(dtype)
+
+    def parameters_stamp(self):
+        return self._version, tuple((model.parameters_stamp(), model.master_coeff, model.master_offset)
+                                    for model in self.models)
+
+    def evaluation_mode(self):
+        # Stage by stage evaluation goes through apply() of every model
+        return super().evaluation_mode()+[self.is_fused(), [model.evaluation_mode() for model in self.models]]
+
+    def evaluates_exactly(self):
+        # Models of stage by stage evaluation use their own apply()
+        return super().evaluates_exactly() and (self.is_fused() or
+                                                all(model.evaluates_exactly() for model in self.models))
+
+    def is_fused(self):
+        if self.fused is not None:
+            return self.fused
+        return self._cached("fused", lambda: sum(stage[0] != "affine" for stage in self._apply_stages()) <= 1)
+
+    def _apply_stages(self):
+        stages = []
+        for model in self.models:
+            stages.extend(model._apply_stages())
+        stages.append(("affine", self.master_coeff, self.master_offset))
+        return stages
+
+    def _apply_fused(self, pixel_data, broken, out):
+        if self.is_fused():
+            run_segments(self.compiled_segments(broken.shape[0]), pixel_data, broken, out)
+        else:
+            super()._apply_fused(pixel_data, broken, out)
 
     def evaluate(self, pixel_data):
         if self.models:
@@ -361,26 +812,39 @@ class Chain(FlatFieldingModel):
             return super().display_parameter_2()
 
 class Interpolative(FlatFieldingModel):
+    PARAMETERS = ("x_frames", "y_frames")
+
     def __init__(self, x_frames=None, y_frames=None):
         super().__init__()
         self.x_frames = x_frames
         self.y_frames = y_frames
 
-    def get_data(self):
+    def get_parameters(self):
         self.get_broken()
         return {
-            "x_frames": self.x_frames.tolist(),
-            "y_frames": self.y_frames.tolist(),
-            "broken": self.broken_pixels.tolist(),
+            "x_frames": self.x_frames,
+            "y_frames": self.y_frames,
+            "broken": self.broken_pixels,
         }
 
     def set_data(self, x_data):
-        self.x_frames = np.array(x_data["x_frames"])
-        self.y_frames = np.array(x_data["y_frames"])
-        self.broken_pixels = np.array(x_data["broken"])
+        self.x_frames = np.asarray(x_data["x_frames"])
+        self.y_frames = np.asarray(x_data["y_frames"])
+        self.broken_pixels = np.asarray(x_data["broken"])
+
+    def knot_tables(self):
+        return self._cached("tables", lambda: tuple(item.astype(self.dtype, copy=False) for item in
+                                                    build_knot_tables(self.x_frames, self.y_frames)))
 
     def evaluate(self, pixel_data):
-        return interpolate_matrix(pixel_data,self.x_frames, self.y_frames)
+        return interpolate_tables(pixel_data, self.knot_tables())
+
+    def _apply_fused(self, pixel_data, broken, out):
+        interpolate_frames(flat_frames(pixel_data), *self.knot_tables(),
+                           self._scalar(self.master_coeff), self._scalar(self.master_offset), broken, flat_frames(out))
+
+    def _apply_stages(self):
+        return [("interpolative", self.knot_tables()), ("affine", self.master_coeff, self.master_offset)]
 
     def evaluate_single(self, pixel_data, i, j):
         xf = self.x_frames[:,i,j]
@@ -389,4 +853,103 @@ class Interpolative(FlatFieldingModel):
 
     def get_broken_auto(self):
         maxes = np.max(self.x_frames, axis=0)
-        return maxes<=1e-6
\ No newline at end of file
+        return maxes<=1e-6
+
+class PixelModelMap(FlatFieldingModel):
+    '''
+    Different models for different pixels. assignment holds index of model for every pixel (-1 is unassigned).
+    Every model is evaluated once on compact array of its pixels only.
+    '''
+    PARAMETERS = ("models", "assignment")
+
+    def __init__(self, models=None, assignment=None):
+        super().__init__()
+        if models:
+            self.models = models
+        else:
+            self.models = []
+        self.assignment = assignment
+
+    def __str__(self):
+        superstr = super().__str__()
+        arr = ", ".join([item.__str__() for item in self.models])
+        return f"{superstr}[{arr}]"
+
+    def assign(self, model, pixels, pixel_shape=(16, 16)):
+        '''
+        Use model for pixels ((W, H) boolean mask or (N, 2) list of (i, j))
+        '''
+        if self.assignment is None:
+            self.assignment = np.full(pixel_shape, -1, dtype=np.int64)
+        assignment = self.assignment.copy()
+        assignment.ravel()[pixel_indices(pixels, assignment.shape)] = len(self.models)
+        self.models.append(model)
+        self.assignment = assignment
+
+    def get_parameters(self):
+        self.get_broken()
+        return {
+            "models": [item.dump(raw=True) for item in self.models],
+            "assignment": self.assignment,
+            "broken": self.broken_pixels
+        }
+
+    def set_data(self, x_data):
+        self.models = [self.create_from_parameters(item) for item in x_data["models"]]
+        self.assignment = np.asarray(x_data["assignment"])
+        self.broken_pixels = np.asarray(x_data["broken"])
+
+    def set_dtype(self, dtype):
+        super().set_dtype(dtype)
+        for model in self.models:
+            model.set_dtype(dtype)
+
+    def parameters_stamp(self):
+        return self._version, tuple((model.parameters_stamp(), model.master_coeff, model.master_offset)
+                                    for model in self.models)
+
+    def groups(self):
+        '''
+        (model, layout of its pixels) for every model having pixels
+        '''
+        def build():
+            result = []
+            for index, model in enumerate(self.models):
+                layout = AliveLayout.from_indices(self.assignment == index, self.assignment.shape)
+                if layout.n_alive:
+                    result.append((model, layout))
+            return result
+        return self._cached("groups", build)
+
+    def _evaluate_into(self, pixel_data, out):
+        # out may be pixel_data itself (Chain stage), groups are disjoint so every pixel is read before written
+        for model, layout in self.groups():
+            compact = layout.compress(pixel_data)
+            result = np.empty(compact.shape, dtype=out.dtype)
+            model._apply_layout(compact, layout, np.zeros(layout.n_alive, dtype=bool), result)
+            layout.scatter(result, out)
+        unassigned = self._cached("unassigned", lambda: np.flatnonzero(self.assignment.ravel() < 0))
+        if unassigned.shape[0]:
+            flat_frames(out)[:, unassigned] = 0.0
+        return out
+
+    def evaluate(self, pixel_data):
+        pixel_data = np.asarray(pixel_data)
+        return self._evaluate_into(pixel_data, np.empty(pixel_data.shape, dtype=self.dtype))
+
+    def _apply_fused(self, pixel_data, broken, out):
+        self._evaluate_into(pixel_data, out)
+        affine_frames(flat_frames(out), self._scalar(self.master_coeff), self._scalar(self.master_offset),
+                      broken, flat_frames(out))
+
+    def evaluate_single(self, pixel_data, i, j):
+        index = self.assignment[i, j]
+        if index < 0:
+            return np.zeros(np.shape(pixel_data))
+        return self.models[index].apply_single(pixel_data, i, j)
+
+    def get_broken_auto(self):
+        broken = self.assignment < 0
+        for index, model in enumerate(self.models):
+            broken = np.logical_or(broken, np.logical_and(self.assignment == index, model.get_broken()))
+        return broken
@@ -0,0 +1,200 @@
+'''
+Content-addressed cache of FlatFieldingModel.apply() results.
+Key is a digest of model parameters (see FlatFieldingModel.dump()) combined with a fingerprint of input data,
+so equal models applied to equal recordings share results regardless of object identity.
+'''
+import hashlib
+import os
+import os.path as ospath
+from collections import OrderedDict
+
+import numpy as np
+
+DEFAULT_MEMORY_BYTES = 1 << 30
+DIGEST_SIZE = 20
+
+
+def _hasher():
+    return hashlib.blake2b(digest_size=DIGEST_SIZE)
+
+
+def _update_digest(hasher, value):
+    if isinstance(value, dict):
+        hasher.update(b"{")
+        for key in sorted(value.keys()):
+            hasher.update(str(key).encode())
+            _update_digest(hasher, value[key])
+        hasher.update(b"}")
+    elif isinstance(value, (list, tuple)):
+        hasher.update(b"[")
+        for item in value:
+            _update_digest(hasher, item)
+        hasher.update(b"]")
+    elif isinstance(value, np.ndarray):
+        _update_array(hasher, value)
+    else:
+        hasher.update(repr(value).encode())
+
+
+def _update_array(hasher, array):
+    hasher.update(f"{array.dtype.str}{array.shape}".encode())
+    hasher.update(memoryview(np.ascontiguousarray(array)).cast("B"))
+
+
+def array_fingerprint(pixel_data):
+    '''
+    Digest of array contents, shape and type. Reads whole array.
+    '''
+    hasher = _hasher()
+    _update_array(hasher, np.asarray(pixel_data))
+    return hasher.hexdigest()
+
+
+def model_digest(model):
+    '''
+    Digest of model parameters (dump() without broken pixels), master coefficients, compute dtype
+    and evaluation mode (LUT, surrogate). Digest of parameters is cached until model changes.
+    '''
+    def build():
+        hasher = _hasher()
+        parameters = dict(model.get_parameters())
+        parameters.pop("broken", None)
+        _update_digest(hasher, {"model": type(model).__name__, "parameters": parameters})
+        return hasher.digest()
+    hasher = _hasher()
+    hasher.update(model._cached("digest", build))
+    _update_digest(hasher, [model.master_coeff, model.master_offset, model.dtype.str, model.evaluation_mode()])
+    return hasher
+
+
+class ResultCache(object):
+    '''
+    LRU cache of arrays limited by total size in bytes with optional on-disk tier.
+    Disk tier stores results as .npy files and survives restarts.
+    '''
+    def __init__(self, max_bytes=DEFAULT_MEMORY_BYTES, directory=None, max_disk_bytes=None):
+        '''
+        :param max_bytes: memory budget, least recently used results are evicted above it
+        :param directory: directory of disk tier, None disables it
+        :param max_disk_bytes: disk budget, oldest files are removed above it. None is unlimited
+        '''
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self._entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    @classmethod
+    def in_workspace(cls, max_bytes=DEFAULT_MEMORY_BYTES, max_disk_bytes=None, subspace="result_cache"):
+        '''
+        Cache with disk tier in Workspace directory (memory only if workspace is not configured)
+        '''
+        from vtl_common.workspace_manager import Workspace
+        return cls(max_bytes, Workspace(subspace).ensure_directory(), max_disk_bytes)
+
+    def key(self, model, pixel_data, broken):
+        hasher = model_digest(model)
+        hasher.update(np.packbits(broken).tobytes())
+        hasher.update(array_fingerprint(pixel_data).encode())
+        return hasher.hexdigest()
+
+    def _path(self, key):
+        return ospath.join(self.directory, key+".npy")
+
+    def get(self, key):
+        '''
+        Cached array or None. Returned array must not be modified.
+        '''
+        value = self._entries.get(key)
+        if value is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+        if self.directory is not None and ospath.isfile(self._path(key)):
+            try:
+                value = np.load(self._path(key))
+            except (OSError, ValueError):
+                value = None
+            if value is not None:
+                self.disk_hits += 1
+                self._store(key, value)
+                return value
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        value = np.array(value)
+        value.flags.writeable = False
+        self._store(key, value)
+        if self.directory is not None:
+            self._write_disk(key, value)
+
+    def _store(self, key, value):
+        if value.nbytes > self.max_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.bytes -= old.nbytes
+        self._entries[key] = value
+        self.bytes += value.nbytes
+        while self.bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.bytes -= evicted.nbytes
+            self.evictions += 1
+
+    def _write_disk(self, key, value):
+        path = self._path(key)
+        temp_path = path+".tmp"
+        with open(temp_path, "wb") as fp:
+            np.save(fp, value)
+        os.replace(temp_path, path)
+        if self.max_disk_bytes is not None:
+            self._trim_disk()
+
+    def _trim_disk(self):
+        files = [ospath.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith(".npy")]
+        files = sorted(files, key=ospath.getmtime)
+        total = sum(ospath.getsize(path) for path in files)
+        for path in files:
+            if total <= self.max_disk_bytes:
+                break
+            total -= ospath.getsize(path)
+            os.remove(path)
+
+    def clear(self, disk=False):
+        self._entries.clear()
+        self.bytes = 0
+        if disk and self.directory is not None:
+            for name in os.listdir(self.directory):
+                if name.endswith(".npy"):
+                    os.remove(ospath.join(self.directory, name))
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+        }
+
+
+_default_cache = None
+
+
+def default_cache():
+    '''
+    Process-wide memory-only cache shared by models enabling result cache without explicit instance
+    '''
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = ResultCache()
+    return _default_cache
@@ -0,0 +1,86 @@
+'''
+Chunked application of flat fielding models to datasets which do not fit in memory.
+Sources and destinations are h5py datasets or anything supporting numpy-like slicing along time axis.
+'''
+import numpy as np
+
+DEFAULT_CHUNK_FRAMES = 4096
+
+
+def aligned_chunk_frames(src, chunk_frames=None):
+    '''
+    Number of frames per read. Rounded up to a multiple of source's HDF5 chunk size along time axis
+    so every read touches whole chunks only.
+    '''
+    if chunk_frames is None:
+        chunk_frames = DEFAULT_CHUNK_FRAMES
+    storage_chunks = getattr(src, "chunks", None)
+    if storage_chunks:
+        step = storage_chunks[0]
+        chunk_frames = max(step, (chunk_frames+step-1)//step*step)
+    return chunk_frames
+
+
+def _read_into(src, buffer, start, end):
+    count = end-start
+    if hasattr(src, "read_direct"):
+        src.read_direct(buffer, np.s_[start:end], np.s_[0:count])
+    else:
+        buffer[:count] = src[start:end]
+    return buffer[:count]
+
+
+def iter_apply(model, src, chunk_frames=None, nobreak=True):
+    '''
+    Yield (start, end, result) for consecutive time chunks of src.
+    result is a view of a buffer reused between iterations, copy it if it has to be kept.
+    '''
+    chunk_frames = aligned_chunk_frames(src, chunk_frames)
+    length = src.shape[0]
+    frame_shape = tuple(src.shape[1:])
+    in_buffer = np.empty((min(chunk_frames, length),)+frame_shape, dtype=src.dtype)
+    out_buffer = np.empty(in_buffer.shape, dtype=model.dtype)
+    for start in range(0, length, chunk_frames):
+        end = min(start+chunk_frames, length)
+        chunk = _read_into(src, in_buffer, start, end)
+        out = out_buffer[:end-start]
+        if nobreak:
+            model.apply_nobreak(chunk, out=out)
+        else:
+            model.apply(chunk, out=out)
+        yield start, end, out
+
+
+def apply_stream(model, src, dst, chunk_frames=None, nobreak=True, progress=None):
+    '''
+    Apply model to src chunk by chunk writing results to dst
+    :param model: FlatFieldingModel
+    :param src: (T, W, H) source dataset
+    :param dst: (T, W, H) destination dataset, see create_output_dataset()
+    :param chunk_frames: frames per chunk, memory use is bounded by this value
+    :param nobreak: zero broken pixels (apply_nobreak) instead of plain apply
+    :param progress: optional callable(done_frames, total_frames)
+    :return: dst
+    '''
+    if tuple(dst.shape) != tuple(src.shape):
+        raise ValueError(f"Destination shape {dst.shape} does not match source shape {src.shape}")
+    for start, end, result in iter_apply(model, src, chunk_frames, nobreak):
+        if hasattr(dst, "write_direct"):
+            dst.write_direct(result, np.s_[0:end-start], np.s_[start:end])
+        else:
+            dst[start:end] = result
+        if progress is not None:
+            progress(end, src.shape[0])
+    return dst
+
+
+def create_output_dataset(group, name, src, model=None, **kwargs):
+    '''
+    Create dataset shaped and chunked like src in h5py group.
+    Data type is taken from model (float64 without model) unless dtype is given
+    '''
+    if getattr(src, "chunks", None) and "chunks" not in kwargs:
+        kwargs["chunks"] = src.chunks
+    if "dtype" not in kwargs:
+        kwargs["dtype"] = np.float64 if model is None else model.dtype
+    return group.create_dataset(name, shape=src.shape, **kwargs)
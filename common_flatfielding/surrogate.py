@@ -0,0 +1,145 @@
+'''
+Piecewise polynomial surrogate of nonlinear models (NonlinearSaturation, NonlinearPileup).
+Input range of every pixel is split into equal segments, model is interpolated in Chebyshev nodes
+of every segment and evaluated with Horner scheme. Segments where error exceeds tolerance on a dense
+verification grid and input outside of fitted range are evaluated analytically.
+'''
+import numpy as np
+import numba as nb
+from numba import prange
+from numpy.polynomial import chebyshev
+
+from .kernels import saturation_value, pileup_value
+from .chain_compiler import STAGE_SATURATION
+
+DEFAULT_SEGMENTS = 32
+DEFAULT_DEGREE = 7
+DEFAULT_TOLERANCE = 1e-6
+# Verification points per segment and polynomial coefficient
+VERIFICATION_DENSITY = 8
+
+
+@nb.njit(inline="always", cache=True)
+def analytic_value(kind, x, params, p, limit):
+    '''
+    Exact model evaluation, limit is maximum of result dtype.
+    Saturation params: inv_a, inv_b, offset. Pileup params: divider, scale, offset, prescaler
+    '''
+    if kind == STAGE_SATURATION:
+        return saturation_value(x, params[0, p], params[1, p], params[2, p])
+    return pileup_value(x*params[3, p], params[0, p], params[1, p], limit)+params[2, p]
+
+
+@nb.njit(parallel=True, cache=True)
+def analytic_frames(kind, params, frames, out):
+    T, P = frames.shape
+    limit = np.finfo(out.dtype).max
+    for t in prange(T):
+        for p in range(P):
+            out[t, p] = analytic_value(kind, frames[t, p], params, p, limit)
+
+
+@nb.njit(parallel=True, cache=True)
+def apply_surrogate(frames, kind, params, low, inv_width, coeffs, exact, master_coeff, master_offset, broken, out):
+    T, P = frames.shape
+    S = coeffs.shape[1]
+    D = coeffs.shape[2]-1
+    limit = np.finfo(out.dtype).max
+    for t in prange(T):
+        for p in range(P):
+            if broken[p]:
+                out[t, p] = 0.0
+                continue
+            x = frames[t, p]
+            position = (x-low[p])*inv_width[p]
+            s = -1
+            # NaN fails both comparisons
+            if 0.0 <= position <= S:
+                s = min(int(position), S-1)
+            if s < 0 or exact[p, s]:
+                value = analytic_value(kind, x, params, p, limit)
+            else:
+                u = 2.0*(position-s)-1.0
+                value = coeffs[p, s, D]
+                for d in range(D-1, -1, -1):
+                    value = value*u+coeffs[p, s, d]
+            out[t, p] = master_coeff*value+master_offset
+
+
+def observed_range(pixel_data):
+    '''
+    Per-pixel (low, high) of (T, W, H) sample ignoring NaN
+    '''
+    pixel_data = np.asarray(pixel_data, dtype=np.float64)
+    return np.nanmin(pixel_data, axis=0), np.nanmax(pixel_data, axis=0)
+
+
+def _monomial_matrix(degree):
+    '''
+    Matrix mapping model values in Chebyshev nodes to monomial coefficients of interpolating polynomial on [-1, 1]
+    '''
+    n = degree+1
+    k = np.arange(n)
+    nodes = np.cos(np.pi*(k+0.5)/n)
+    to_chebyshev = 2.0/n*np.cos(np.pi*np.outer(k, k+0.5)/n)
+    to_chebyshev[0] /= 2
+    to_monomial = np.zeros((n, n))
+    for j in range(n):
+        monomial = chebyshev.cheb2poly(np.eye(n)[j])
+        to_monomial[:monomial.shape[0], j] = monomial
+    return nodes, to_monomial @ to_chebyshev
+
+
+class PolynomialSurrogate(object):
+    '''
+    Fitted surrogate for one model, see module description
+    :param kind: chain_compiler.STAGE_SATURATION or chain_compiler.STAGE_PILEUP
+    :param params: (4, P) analytic parameters, see analytic_value()
+    :param low: per-pixel lower bound of fitted input range
+    :param high: per-pixel upper bound of fitted input range
+    :param tolerance: maximum allowed |surrogate-exact|/(1+|exact|)
+    '''
+    def __init__(self, kind, params, low, high, tolerance=DEFAULT_TOLERANCE, segments=DEFAULT_SEGMENTS,
+                 degree=DEFAULT_DEGREE):
+        self.kind = kind
+        self.params = np.ascontiguousarray(params, dtype=np.float64)
+        pixels = self.params.shape[1]
+        self.tolerance = tolerance
+        low = np.broadcast_to(np.asarray(low, dtype=np.float64).ravel(), (pixels,)).copy()
+        high = np.broadcast_to(np.asarray(high, dtype=np.float64).ravel(), (pixels,)).copy()
+        undefined = np.logical_not(np.logical_and(np.isfinite(low), np.isfinite(high)))
+        low[undefined] = 0.0
+        high[undefined] = 0.0
+        width = np.maximum((high-low)/segments, np.finfo(np.float64).tiny)
+        self.low = low
+        self.inv_width = 1.0/width
+        nodes, node_matrix = _monomial_matrix(degree)
+        x = low+(np.arange(segments).reshape(-1, 1, 1)+(nodes.reshape(1, -1, 1)+1)/2)*width
+        values = self._exact(x.reshape(-1, pixels)).reshape(segments, degree+1, pixels)
+        # (P, S, degree+1) monomial coefficients in local variable u in [-1, 1]
+        self.coeffs = np.ascontiguousarray(np.einsum("dk,skp->psd", node_matrix, values))
+        u = np.linspace(-1.0, 1.0, VERIFICATION_DENSITY*(degree+1))
+        x = low+(np.arange(segments).reshape(-1, 1, 1)+(u.reshape(1, -1, 1)+1)/2)*width
+        exact = self._exact(x.reshape(-1, pixels)).reshape(segments, u.shape[0], pixels)
+        approximation = np.einsum("psd,gd->sgp", self.coeffs, np.vander(u, degree+1, increasing=True))
+        with np.errstate(invalid="ignore"):
+            error = np.abs(approximation-exact)/(1+np.abs(exact))
+        error = np.where(np.isfinite(error), error, np.inf).max(axis=1).T
+        self.exact = np.ascontiguousarray(np.logical_or(error > tolerance, undefined.reshape(-1, 1)))
+        self.max_error = np.where(self.exact, 0.0, error).max(axis=1)
+
+    def _exact(self, frames):
+        out = np.empty(frames.shape)
+        analytic_frames(self.kind, self.params, np.ascontiguousarray(frames), out)
+        return out
+
+    @property
+    def exact_fraction(self):
+        '''
+        Fraction of segments evaluated analytically because surrogate did not meet tolerance
+        '''
+        return np.mean(self.exact)
+
+    def apply(self, frames, master_coeff, master_offset, broken, out):
+        apply_surrogate(frames, self.kind, self.params, self.low, self.inv_width, self.coeffs, self.exact,
+                        master_coeff, master_offset, broken, out)
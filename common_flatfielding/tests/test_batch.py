@@ -0,0 +1,52 @@
+import os.path as ospath
+import pickle
+import unittest
+
+import numpy as np
+
+from ..batch import SharedModel, output_paths, run_batch
+from ..models import Linear, NonlinearSaturation, Chain
+
+
+class SharedModelTransfer(unittest.TestCase):
+    def test_evaluation_settings_survive_transfer(self):
+        rng = np.random.default_rng(0)
+        linear = Linear(rng.uniform(0.5, 2.0, (16, 16)), rng.uniform(0.0, 3.0, (16, 16)))
+        saturation = NonlinearSaturation(rng.uniform(200.0, 400.0, (16, 16)), rng.uniform(0.5, 2.0, (16, 16)),
+                                         rng.uniform(0.0, 1.0, (16, 16)))
+        saturation.enable_surrogate(np.zeros((16, 16)), np.full((16, 16), 100.0))
+        chain = Chain([saturation, linear])
+        chain.enable_lut(1000)
+        chain.fused = False
+        chain.set_dtype(np.float32)
+        shared = SharedModel(chain)
+        attached = []
+        try:
+            model = pickle.loads(pickle.dumps(shared)).build(attached)
+            self.assertEqual(model.dtype, chain.dtype)
+            self.assertEqual(model.lut_max_count, 1000)
+            self.assertIs(model.fused, False)
+            np.testing.assert_array_equal(model.models[0].surrogate_settings[1], np.full((16, 16), 100.0))
+            self.assertEqual(repr(model.evaluation_mode()), repr(chain.evaluation_mode()))
+            signal = rng.integers(0, 1000, (20, 16, 16))
+            np.testing.assert_array_equal(model.apply(signal), chain.apply(signal))
+        finally:
+            for block in attached:
+                block.close()
+            shared.close()
+
+
+class OutputPaths(unittest.TestCase):
+    def test_unique_names(self):
+        self.assertEqual(output_paths(["a/run.h5", "a/other.h5"], "out"),
+                         [ospath.join("out", "run_ff.h5"), ospath.join("out", "other_ff.h5")])
+
+    def test_collision_fails_before_processing(self):
+        with self.assertRaises(ValueError):
+            output_paths(["a/run.h5", "b/run.h5"], "out")
+        with self.assertRaises(ValueError):
+            run_batch(Linear(np.ones((16, 16)), np.zeros((16, 16))), ["a/run.h5", "b/run.h5"], "out")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,37 @@
+import unittest
+
+import numpy as np
+
+from ..models import Linear, NonlinearSaturation, Chain
+from .test_pixel_model_map import pixel_map
+
+
+class ChainEvaluation(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(3)
+        self.linear = Linear(rng.uniform(0.5, 2.0, (16, 16)), rng.uniform(0.0, 3.0, (16, 16)))
+        self.saturation = NonlinearSaturation(rng.uniform(200.0, 400.0, (16, 16)), rng.uniform(0.5, 2.0, (16, 16)),
+                                              rng.uniform(0.0, 1.0, (16, 16)))
+        self.model_map = pixel_map(rng)
+        self.signal = rng.uniform(0.0, 200.0, (100, 16, 16))
+
+    def test_default_fused_choice(self):
+        self.assertTrue(Chain([self.linear, self.linear]).is_fused())
+        self.assertTrue(Chain([self.saturation, self.linear]).is_fused())
+        self.assertFalse(Chain([self.saturation, self.linear, self.saturation]).is_fused())
+        chain = Chain([self.saturation, self.saturation])
+        chain.fused = True
+        self.assertTrue(chain.is_fused())
+
+    def test_inplace_apply_with_model_segment(self):
+        for models in ([self.model_map, self.linear], [self.linear, self.model_map, self.linear]):
+            chain = Chain(models)
+            chain.fused = True
+            reference = chain.apply(self.signal)
+            data = self.signal.copy()
+            chain.apply(data, out=data)
+            np.testing.assert_allclose(data, reference, rtol=1e-12, atol=1e-12)
+
+
+if __name__ == "__main__":
+    unittest.main()
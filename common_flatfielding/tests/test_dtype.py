@@ -0,0 +1,31 @@
+import unittest
+
+import numpy as np
+
+from ..models import NonlinearPileup
+
+
+class PileupFloat32(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        sensitivity = rng.uniform(0.5, 2.0, (16, 16))
+        # Zero sensitivity gives infinite result, replaced by maximum of model dtype
+        sensitivity[0, 0] = 0.0
+        self.model = NonlinearPileup(sensitivity, rng.uniform(100.0, 3000.0, (16, 16)), 1.0,
+                                     rng.uniform(0.0, 1.0, (16, 16)))
+        self.signal = rng.uniform(1.0, 30.0, (50, 16, 16))
+
+    def test_results_in_model_dtype(self):
+        self.model.set_dtype(np.float32)
+        for result in (self.model.evaluate(self.signal), self.model.evaluate_single(self.signal[:, 0, 0], 0, 0),
+                       self.model.apply(self.signal)):
+            self.assertEqual(result.dtype, np.float32)
+            self.assertTrue(np.all(np.isfinite(result)))
+        self.assertTrue(np.all(self.model.evaluate(self.signal)[:, 0, 0] == np.finfo(np.float32).max))
+
+    def test_float64_clamp(self):
+        self.assertTrue(np.all(self.model.evaluate(self.signal)[:, 0, 0] == np.finfo(np.float64).max))
+
+
+if __name__ == "__main__":
+    unittest.main()
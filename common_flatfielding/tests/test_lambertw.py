@@ -0,0 +1,53 @@
+import unittest
+
+import numpy as np
+from scipy.special import lambertw
+
+from ..lambertw import lambertw_real, BRANCH_POINT
+from ..models import NonlinearPileup
+
+# Maximal deviations of compiled paths from scipy reference
+LAMBERTW_TOLERANCE = 1e-7
+PILEUP_TOLERANCE = 1e-7
+
+
+class LambertW(unittest.TestCase):
+    def test_matches_scipy(self):
+        rng = np.random.default_rng(0)
+        x = np.concatenate([rng.uniform(-1/np.e, 0.0, 1000000), rng.uniform(0.0, 1e3, 100000),
+                            BRANCH_POINT+np.logspace(-16, -2, 1000), [0.0, np.inf]])
+        x = x[x != BRANCH_POINT]
+        reference = lambertw(x).real
+        compiled = lambertw_real(x)
+        self.assertTrue(np.array_equal(np.isfinite(reference), np.isfinite(compiled)))
+        valid = np.isfinite(reference)
+        error = np.max(np.abs(compiled[valid]-reference[valid])/(1+np.abs(reference[valid])))
+        self.assertLessEqual(error, LAMBERTW_TOLERANCE)
+
+    def test_special_values(self):
+        # scipy gives NaN exactly at branch point, W0(-1/e) = -1
+        compiled = lambertw_real(np.array([BRANCH_POINT, BRANCH_POINT*(1+1e-14), -0.5, np.nan, 0.0, np.inf]))
+        np.testing.assert_array_equal(compiled, [-1.0, -1.0, np.nan, np.nan, 0.0, np.inf])
+
+
+class PileupAgainstScipy(unittest.TestCase):
+    def test_matches_original_evaluation(self):
+        # Original evaluation, including saturated input above divider/e
+        rng = np.random.default_rng(0)
+        sensitivity = rng.uniform(0.5, 2.0, (16, 16))
+        divider = rng.uniform(100.0, 3000.0, (16, 16))
+        prescaler = rng.uniform(0.5, 2.0, (16, 16))
+        offset = rng.uniform(0.0, 1.0, (16, 16))
+        model = NonlinearPileup(sensitivity, divider, prescaler, offset)
+        signal = rng.uniform(0.0, 3000.0, (2000, 16, 16))
+        for pixel_data in (signal, np.round(signal).astype(np.int64)):
+            clip = np.clip(pixel_data*prescaler, 0, divider/np.e)
+            with np.errstate(invalid="ignore"):
+                reference = np.nan_to_num(-divider/sensitivity*lambertw(-clip/divider).real)+offset
+            for result in (model.evaluate(pixel_data), model.apply(pixel_data)):
+                error = np.max(np.abs(result-reference)/(1+np.abs(reference)))
+                self.assertLessEqual(error, PILEUP_TOLERANCE)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,48 @@
+import unittest
+
+import numpy as np
+
+from ..lazy_view import LazyView
+from ..models import Linear, NonlinearSaturation, Chain
+
+
+class PixelSeries(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.linear = Linear(rng.uniform(0.5, 2.0, (16, 16)), rng.uniform(0.0, 3.0, (16, 16)))
+        self.saturation = NonlinearSaturation(rng.uniform(200.0, 400.0, (16, 16)), rng.uniform(0.5, 2.0, (16, 16)),
+                                              rng.uniform(0.0, 1.0, (16, 16)))
+        self.raw = rng.integers(0, 200, (600, 16, 16))
+
+    def check_series(self, model):
+        view = LazyView(model, self.raw, block_frames=128)
+        reference = model.apply_nobreak(self.raw)
+        np.testing.assert_array_equal(view[:, 3, 5], reference[:, 3, 5])
+        np.testing.assert_array_equal(view[10:300:7, -1, 2], reference[10:300:7, -1, 2])
+        self.assertEqual(view[42, 3, 5], reference[42, 3, 5])
+
+    def test_surrogate(self):
+        self.saturation.enable_surrogate(np.zeros((16, 16)), np.full((16, 16), 200.0), tolerance=1e-3)
+        self.assertFalse(self.saturation.evaluates_exactly())
+        self.check_series(self.saturation)
+
+    def test_lut(self):
+        self.saturation.enable_lut(100)
+        self.check_series(self.saturation)
+
+    def test_stage_by_stage_chain(self):
+        self.saturation.enable_surrogate(np.zeros((16, 16)), np.full((16, 16), 200.0), tolerance=1e-3)
+        chain = Chain([self.saturation, self.linear])
+        chain.fused = False
+        self.assertFalse(chain.evaluates_exactly())
+        self.check_series(chain)
+
+    def test_exact(self):
+        self.assertTrue(Chain([self.saturation, self.linear]).evaluates_exactly())
+        view = LazyView(self.saturation, self.raw)
+        np.testing.assert_allclose(view[:, 3, 5], self.saturation.apply_nobreak(self.raw)[:, 3, 5],
+                                   rtol=1e-12, atol=1e-12)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+import unittest
+
+import numpy as np
+
+from ..models import Linear, NonlinearSaturation, Chain, PixelModelMap
+
+
+def pixel_map(rng):
+    '''
+    Map with two models and unassigned pixels
+    '''
+    model_map = PixelModelMap()
+    mask = rng.random((16, 16))
+    model_map.assign(Linear(rng.uniform(0.5, 2.0, (16, 16)), rng.uniform(0.0, 3.0, (16, 16))), mask < 0.4)
+    model_map.assign(NonlinearSaturation(rng.uniform(200.0, 400.0, (16, 16)), rng.uniform(0.5, 2.0, (16, 16)),
+                                         rng.uniform(0.0, 1.0, (16, 16))), mask > 0.6)
+    model_map.master_coeff = 1.5
+    model_map.master_offset = 5.0
+    return model_map
+
+
+class PixelModelMapInChain(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.linear = Linear(rng.uniform(0.5, 2.0, (16, 16)), rng.uniform(0.0, 3.0, (16, 16)))
+        self.model_map = pixel_map(rng)
+        self.chain = Chain([self.linear, self.model_map])
+        self.signal = rng.uniform(0.0, 200.0, (300, 16, 16))
+
+    def stage_by_stage(self):
+        return self.chain.master_coeff*self.model_map.apply(self.linear.apply(self.signal))+self.chain.master_offset
+
+    def test_apply_matches_stage_by_stage(self):
+        reference = self.stage_by_stage()
+        for fused in (True, False):
+            self.chain.fused = fused
+            np.testing.assert_allclose(self.chain.apply(self.signal), reference, rtol=1e-12, atol=1e-12)
+
+    def test_apply_nobreak_matches_stage_by_stage(self):
+        reference = np.where(self.chain.get_broken(), 0.0, self.stage_by_stage())
+        np.testing.assert_allclose(self.chain.apply_nobreak(self.signal), reference, rtol=1e-12, atol=1e-12)
+
+
+class PixelModelMapSeries(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(1)
+        self.model_map = pixel_map(rng)
+        broken = np.zeros((16, 16), dtype=bool)
+        assigned = np.argwhere(self.model_map.assignment >= 0)
+        broken[tuple(assigned[0])] = True
+        self.model_map.set_broken(broken)
+        self.signal = rng.uniform(0.0, 200.0, (50, 16, 16))
+
+    def check_series(self, model):
+        reference = model.apply_nobreak(self.signal)
+        mask = np.ones((16, 16), dtype=bool)
+        indices = np.argwhere(mask)
+        series = model.evaluate_pixels(self.signal, indices)
+        np.testing.assert_allclose(series, reference.reshape(reference.shape[0], -1), rtol=1e-12, atol=1e-12)
+        # Broken and unassigned pixels are zero
+        self.assertTrue(np.all(series[:, model.get_broken().ravel()] == 0.0))
+
+    def test_evaluate_pixels_zeroes_broken(self):
+        self.check_series(self.model_map)
+
+    def test_evaluate_pixels_chain_ending_in_map(self):
+        rng = np.random.default_rng(2)
+        self.check_series(Chain([Linear(rng.uniform(0.5, 2.0, (16, 16)), rng.uniform(0.0, 3.0, (16, 16))),
+                                 self.model_map]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+'''
+Compile numba kernels (or load them from persistent cache) before first real use.
+'''
+import time
+import numpy as np
+
+from .models import Linear, NonlinearSaturation, NonlinearPileup, Interpolative, Chain, PixelModelMap
+from .fitting import LinearAccumulator
+from .broken_detection import BrokenPixelDetector
+from .surrogate import observed_range
+from .lambertw import lambertw_real
+
+WARMUP_FRAMES = 8
+
+
+def synthetic_models(rng, knots=64):
+    '''
+    Random Linear, NonlinearSaturation and Interpolative models of 16x16 pixels (also used by benchmarks)
+    '''
+    linear = Linear(rng.uniform(0.5, 2.0, (16, 16)), rng.uniform(0.0, 3.0, (16, 16)))
+    saturation = NonlinearSaturation(rng.uniform(200.0, 400.0, (16, 16)), rng.uniform(0.5, 2.0, (16, 16)),
+                                     rng.uniform(0.0, 1.0, (16, 16)))
+    x_frames = np.sort(rng.uniform(0.0, 200.0, (knots, 16, 16)), axis=0)
+    interpolative = Interpolative(x_frames, np.sort(rng.uniform(0.0, 200.0, knots)))
+    return linear, saturation, interpolative
+
+
+def synthetic_signal(rng, frames):
+    '''
+    Random walk (frames, 16, 16) signal
+    '''
+    return np.abs(np.cumsum(rng.normal(0.0, 1.0, (frames, 16, 16)), axis=0))+20.0
+
+
+def _models(rng):
+    linear, saturation, interpolative = synthetic_models(rng, knots=4)
+    pileup = NonlinearPileup(rng.uniform(0.5, 2.0, (16, 16)), rng.uniform(2000.0, 4000.0, (16, 16)), 1.0,
+                             rng.uniform(0.0, 1.0, (16, 16)))
+    mosaic = PixelModelMap()
+    mosaic.assign(linear, rng.random((16, 16)) < 0.5)
+    mosaic.assign(pileup, mosaic.assignment < 0)
+    return [linear, saturation, pileup, interpolative, Chain([saturation, pileup, linear, interpolative]), mosaic]
+
+
+def warmup(dtypes=(np.float64, np.float32), gui=False):
+    '''
+    Run every kernel once on tiny data for float64 and float32 compute modes
+    :param gui: also compile signal plotter kernels (imports GUI modules)
+    :return: seconds spent
+    '''
+    start = time.perf_counter()
+    rng = np.random.default_rng(0)
+    signal = synthetic_signal(rng, WARMUP_FRAMES)
+    counts = rng.integers(0, 16, signal.shape)
+    for model in _models(rng):
+        model.set_broken(np.zeros((16, 16), dtype=bool))
+        for dtype in dtypes:
+            model.set_dtype(dtype)
+            model.apply_nobreak(signal.astype(dtype))
+            model.evaluate_pixels(signal.astype(dtype), [[0, 0]])
+            model.enable_lut(max_count=15)
+            model.apply(counts)
+            model.disable_lut()
+            model.enable_evaluation_cache()
+            model.apply(signal)
+            model.disable_evaluation_cache()
+            if isinstance(model, (NonlinearSaturation, NonlinearPileup)):
+                model.enable_surrogate(*observed_range(signal), segments=2, degree=2)
+                model.apply(signal.astype(dtype))
+                model.disable_surrogate()
+    lambertw_real(np.linspace(-1/np.e, 1.0, WARMUP_FRAMES))
+    LinearAccumulator().update(signal, np.arange(WARMUP_FRAMES, dtype=np.float64))
+    BrokenPixelDetector().update(signal)
+    if gui:
+        from vtl_common.localized_GUI.signal_plotter.time_plotter import moving_average, peak_filter
+        from vtl_common.localized_GUI.signal_plotter.grid_display import hsv_to_rgb
+        from vtl_common.localized_GUI.signal_plotter.binsearch import binsearch_tgt
+        for dtype in dtypes:
+            series = signal[:, 0, 0].astype(dtype)
+            moving_average(series, 3)
+            peak_filter(signal.astype(dtype), np.argmax(signal, axis=0), 3)
+        hsv_to_rgb(120.0, 0.5, 0.5)
+        binsearch_tgt(np.arange(WARMUP_FRAMES, dtype=np.float64), 3.0)
+    return time.perf_counter()-start
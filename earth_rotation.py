@@ -0,0 +1,183 @@
+'''
+Vectorized Earth Rotation Angle (IAU 2000):
+ERA = 2*pi*(0.7790572732640 + 1.00273781191135448*(JD_UT1-2451545.0))
+for arrays of unix or JD (UTC) times without astropy overhead.
+
+UT1 is taken equal to UTC unless UT1-UTC table is given. Dut1Table reads IERS finals2000A, EOP C04 files or
+plain (MJD, UT1-UTC) columns from local disk, so no network access is needed.
+Deviation from astropy Time.earth_rotation_angle(0) (see compare_with_astropy()):
+ - with UT1-UTC table from the same IERS data (Dut1Table.bundled()) it depends on date range:
+   about 1e-10 rad where final EOP C04 values exist (6e-11 for 2017-2023),
+   up to about 6e-9 rad over predicted finals2000A values (4.6e-9 to 5.3e-9 for 2023 on)
+ - without table: up to 6.6e-5 rad (|UT1-UTC| < 0.9 s)
+Times are POSIX: astropy "unix" format spreads days ending with a leap second over 86401 s,
+on such days results differ from astropy by up to 1 s of rotation (7.3e-5 rad).
+'''
+import numpy as np
+import numba as nb
+from numba import prange
+
+ERA_OFFSET = 0.7790572732640
+# Fractional part of Earth rotation rate in turns per UT1 day
+ERA_RATE_FRACTION = 0.00273781191135448
+J2000_JD = 2451545.0
+# Unix time of JD 2451545.0 (2000-01-01 12:00 UTC)
+J2000_UNIX = 946728000.0
+UNIX_EPOCH_MJD = 40587.0
+MJD_OFFSET = 2400000.5
+SECONDS_PER_DAY = 86400.0
+
+
+@nb.njit(parallel=True, cache=True)
+def era_kernel(times, epoch, day_scale, dut1, out):
+    '''
+    ERA of (times-epoch)*day_scale days since J2000 plus dut1 seconds.
+    Integer part of day count is dropped before multiplication to keep precision (as erfa.era00 does)
+    :param dut1: UT1-UTC per time or single value for all times
+    '''
+    N = times.shape[0]
+    shared = dut1.shape[0] == 1
+    for i in prange(N):
+        correction = dut1[0] if shared else dut1[i]
+        days = (times[i]-epoch)*day_scale+correction/SECONDS_PER_DAY
+        theta = (days-np.floor(days))+ERA_OFFSET+ERA_RATE_FRACTION*days
+        out[i] = 2*np.pi*(theta-np.floor(theta))
+
+
+class Dut1Table(object):
+    '''
+    UT1-UTC values sampled by MJD (UTC). Leap second steps are removed before linear interpolation
+    and restored after it. Times outside of table get nearest edge value.
+    '''
+    def __init__(self, mjd, dut1):
+        mjd = np.asarray(mjd, dtype=np.float64)
+        dut1 = np.asarray(dut1, dtype=np.float64)
+        order = np.argsort(mjd)
+        self.mjd = mjd[order]
+        self.dut1 = dut1[order]
+        jumps = np.diff(self.dut1)
+        jumps = np.where(np.abs(jumps) > 0.5, np.round(jumps), 0.0)
+        # Leap second applies from the first sample after the jump
+        self.step_mjd = self.mjd[1:][jumps != 0]
+        self.step_size = jumps[jumps != 0]
+        self.continuous = self.dut1-np.concatenate([[0.0], np.cumsum(jumps)])
+
+    def interpolate(self, mjd):
+        '''
+        UT1-UTC in seconds for MJD (UTC)
+        '''
+        mjd = np.asarray(mjd, dtype=np.float64)
+        steps = np.concatenate([[0.0], np.cumsum(self.step_size)])
+        return np.interp(mjd, self.mjd, self.continuous)+steps[np.searchsorted(self.step_mjd, mjd, side="right")]
+
+    @staticmethod
+    def _parse_finals(lines):
+        mjd = []
+        dut1 = []
+        for line in lines:
+            # Final Bulletin B value when present, Bulletin A otherwise
+            value = line[154:165].strip() or line[58:68].strip()
+            if not value:
+                continue
+            mjd.append(float(line[7:15]))
+            dut1.append(float(value))
+        return mjd, dut1
+
+    @staticmethod
+    def _parse_columns(lines, mjd_column=0, dut1_column=1):
+        mjd = []
+        dut1 = []
+        for line in lines:
+            line = line.split("#")[0].replace(",", " ").split()
+            if len(line) <= max(mjd_column, dut1_column):
+                continue
+            try:
+                mjd.append(float(line[mjd_column]))
+                dut1.append(float(line[dut1_column]))
+            except ValueError:
+                # Header
+                continue
+        return mjd, dut1
+
+    @staticmethod
+    def load(file_path, file_format=None):
+        '''
+        :param file_format: "finals" for IERS finals2000A fixed width files, "eopc04" for IERS EOP C04 series,
+        "columns" for whitespace or comma separated MJD and UT1-UTC. Finals or columns are guessed by default
+        '''
+        with open(file_path, "r") as fp:
+            lines = fp.read().splitlines()
+        if file_format is None:
+            first = next((line for line in lines if line.strip() and not line.startswith("#")), "")
+            file_format = "finals" if len(first) >= 68 and "," not in first else "columns"
+        if file_format == "finals":
+            mjd, dut1 = Dut1Table._parse_finals(lines)
+        elif file_format == "eopc04":
+            mjd, dut1 = Dut1Table._parse_columns(lines, 4, 7)
+        elif file_format == "columns":
+            mjd, dut1 = Dut1Table._parse_columns(lines)
+        else:
+            raise ValueError(f"Unknown UT1-UTC table format {file_format}")
+        if not mjd:
+            raise ValueError(f"No UT1-UTC values in {file_path}")
+        return Dut1Table(mjd, dut1)
+
+    @staticmethod
+    def bundled():
+        '''
+        Table from IERS files shipped with astropy (astropy-iers-data package): EOP C04 series
+        continued with finals2000A, as astropy itself combines them
+        '''
+        from astropy.utils import iers
+        final = Dut1Table.load(iers.IERS_B_FILE, "eopc04")
+        rapid = Dut1Table.load(iers.IERS_A_FILE, "finals")
+        later = rapid.mjd > final.mjd[-1]
+        return Dut1Table(np.concatenate([final.mjd, rapid.mjd[later]]),
+                         np.concatenate([final.dut1, rapid.dut1[later]]))
+
+
+def earth_rotation_angle(times, time_format="unix", dut1=None):
+    '''
+    Earth rotation angle in radians, [0, 2*pi)
+    :param times: array of UTC times
+    :param time_format: "unix" (seconds) or "jd" (days)
+    :param dut1: None (UT1=UTC), UT1-UTC in seconds (scalar or per time) or Dut1Table
+    '''
+    times = np.asarray(times, dtype=np.float64)
+    shape = times.shape
+    times = np.ascontiguousarray(times.ravel())
+    if time_format == "unix":
+        epoch, day_scale = J2000_UNIX, 1.0/SECONDS_PER_DAY
+    elif time_format == "jd":
+        epoch, day_scale = J2000_JD, 1.0
+    else:
+        raise ValueError(f"Unknown time format {time_format}")
+    if dut1 is None:
+        correction = np.zeros(1)
+    elif isinstance(dut1, Dut1Table):
+        if time_format == "unix":
+            mjd = times/SECONDS_PER_DAY+UNIX_EPOCH_MJD
+        else:
+            mjd = times-MJD_OFFSET
+        correction = dut1.interpolate(mjd)
+    else:
+        correction = np.ascontiguousarray(np.broadcast_to(np.asarray(dut1, dtype=np.float64), shape).ravel())
+        if correction.shape[0] == 0:
+            correction = np.zeros(1)
+    out = np.empty(times.shape[0])
+    era_kernel(times, epoch, day_scale, correction, out)
+    return out.reshape(shape)
+
+
+def compare_with_astropy(unix_times, dut1=None):
+    '''
+    Maximal absolute difference (radians) from astropy Time.earth_rotation_angle(0).
+    Astropy is not allowed to download IERS tables, bundled ones are used.
+    '''
+    from astropy.time import Time
+    from astropy.utils import iers
+    unix_times = np.asarray(unix_times, dtype=np.float64)
+    with iers.conf.set_temp("auto_download", False):
+        reference = Time(unix_times, format="unix").earth_rotation_angle(0).radian
+    difference = earth_rotation_angle(unix_times, dut1=dut1)-reference
+    return np.max(np.abs(np.mod(difference+np.pi, 2*np.pi)-np.pi))
@@ -39,7 +39,7 @@ def y0_from_pmt(alive_matrix):
     return low, high, fullsize
 
 
-@nb.njit()
+@nb.njit(cache=True)
 def hsv_to_rgb(h,s,v):
     '''
     0<=h<=360
@@ -28,15 +28,25 @@ def window_limiting(index, window, target_length):
         start = end - window
     return start, end
 
-@nb.njit()
-def moving_average(src, win):
-    res = np.zeros(shape=src.shape)
+def float_dtype(dtype):
+    '''
+    Floating point types are kept (float32 data stay float32), integers are averaged in float64
+    '''
+    if np.issubdtype(dtype, np.floating):
+        return dtype
+    return np.float64
+
+@nb.njit(cache=True)
+def moving_average_into(src, win, res):
     for i in range(src.shape[0]):
         start, end = window_limiting(i,win,src.shape[0])
         res[i] = np.mean(src[start:end])
     return res
 
-@nb.njit()
+def moving_average(src, win):
+    return moving_average_into(src, win, np.zeros(shape=src.shape, dtype=float_dtype(src.dtype)))
+
+@nb.njit(cache=True)
 def peak_filter(src,peaks,window):
     dst = src.copy()
     for k in range(dst.shape[0]):
@@ -75,7 +85,8 @@ class MainPlotter(Plotter):
         self._uses_modulation = False
         self.use_mean = False
         self.flatten_ma = 1
-        self.accumulated, = self.axes.plot(x_plot, np.zeros(shape=display_data.shape[0]), "-",
+        self.accumulated, = self.axes.plot(x_plot, np.zeros(shape=display_data.shape[0],
+                                                                   dtype=float_dtype(display_data.dtype)), "-",
                                            color="black", label="_hidden")
         self.accumulated.set_visible(False)
         box = self.axes.get_position()
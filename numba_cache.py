@@ -0,0 +1,48 @@
+'''
+Location of persistent numba cache for kernels compiled with cache=True.
+By default numba writes cache next to sources (__pycache__). When package directory is read-only
+cache is redirected to user cache directory. NUMBA_CACHE_DIR set by user is always respected.
+Must run before modules defining kernels are imported (done by vtl_common/__init__.py).
+Numba checks only timestamp of the file defining a cached kernel: after editing inlined helpers
+from other modules remove the cache (or touch files using them).
+'''
+import os
+import os.path as ospath
+import sys
+import tempfile
+
+PACKAGE_DIR = ospath.dirname(ospath.abspath(__file__))
+
+
+def _user_cache_dir():
+    base = os.environ.get("XDG_CACHE_HOME") or ospath.join(ospath.expanduser("~"), ".cache")
+    return ospath.join(base, "vtl_common", "numba")
+
+
+def _writable(directory):
+    try:
+        os.makedirs(directory, exist_ok=True)
+    except OSError:
+        return False
+    return os.access(directory, os.W_OK)
+
+
+def configure_cache():
+    '''
+    Redirect numba cache if package directory is not writable
+    :return: cache directory or None when numba default is used
+    '''
+    if os.environ.get("NUMBA_CACHE_DIR"):
+        return os.environ["NUMBA_CACHE_DIR"]
+    if os.access(PACKAGE_DIR, os.W_OK):
+        return None
+    directory = _user_cache_dir()
+    if not _writable(directory):
+        directory = ospath.join(tempfile.gettempdir(), f"vtl_common_numba_{os.getuid() if hasattr(os, 'getuid') else 0}")
+        if not _writable(directory):
+            return None
+    # Environment is read when numba is imported and is inherited by worker processes
+    os.environ["NUMBA_CACHE_DIR"] = directory
+    if "numba" in sys.modules:
+        sys.modules["numba"].config.CACHE_DIR = directory
+    return directory
@@ -0,0 +1,144 @@
+'''
+Compiled star projection kernels used by astronomy.StarCatalog and astronomy.StarOccupancy.
+Focal plane geometry (pixel size, half gap, half pixels) is passed explicitly.
+'''
+import numpy as np
+import numba as nb
+from numba import prange
+
+
+@nb.njit(inline="always", cache=True)
+def project_star(sin_a, cos_a, sin_ra, cos_ra, sin_dec, cos_dec, sin_dec0, cos_dec0, sin_psi, cos_psi, f):
+    '''
+    Star.get_local_coords for precomputed trigonometric terms.
+    a = era+ra0, phase = a-ra is expanded so no trigonometric functions are evaluated per star and time
+    '''
+    cos_phase = cos_a*cos_ra+sin_a*sin_ra
+    sin_phase = sin_a*cos_ra-cos_a*sin_ra
+    z = sin_dec0*sin_dec+cos_dec0*cos_dec*cos_phase
+    x = sin_dec0*cos_dec*sin_psi*cos_phase-cos_dec0*sin_dec*sin_psi-cos_psi*sin_phase*cos_dec
+    y = -sin_dec0*cos_dec*cos_psi*cos_phase+cos_dec0*sin_dec*cos_psi-sin_psi*sin_phase*cos_dec
+    return -x*f/z, y*f/z, z > 0
+
+
+@nb.njit(inline="always", cache=True)
+def focal_index(coord, pixel_size, half_gap, half_pixels):
+    '''
+    astronomy.find_index for single coordinate, -1 outside of sensitive area
+    '''
+    coord_abs = abs(coord)
+    if not (half_gap <= coord_abs <= half_gap+half_pixels*pixel_size):
+        return -1
+    pre_index = min(int((coord_abs-half_gap)/pixel_size+half_pixels), 2*half_pixels-1)
+    if coord > 0:
+        return pre_index
+    if coord < 0:
+        return 2*half_pixels-1-pre_index
+    return 0
+
+
+@nb.njit(parallel=True, cache=True)
+def project_catalog(sin_a, cos_a, sin_ra, cos_ra, sin_dec, cos_dec, dec0, psi, f, x_out, y_out, visible_out):
+    T = sin_a.shape[0]
+    N = sin_ra.shape[0]
+    sin_dec0 = np.sin(dec0)
+    cos_dec0 = np.cos(dec0)
+    sin_psi = np.sin(psi)
+    cos_psi = np.cos(psi)
+    for t in prange(T):
+        for n in range(N):
+            x_out[t, n], y_out[t, n], visible_out[t, n] = project_star(
+                sin_a[t], cos_a[t], sin_ra[n], cos_ra[n], sin_dec[n], cos_dec[n],
+                sin_dec0, cos_dec0, sin_psi, cos_psi, f)
+
+
+@nb.njit(parallel=True, cache=True)
+def pixel_catalog(sin_a, cos_a, sin_ra, cos_ra, sin_dec, cos_dec, dec0, psi, f,
+                  pixel_size, half_gap, half_pixels, i_out, j_out):
+    T = sin_a.shape[0]
+    N = sin_ra.shape[0]
+    sin_dec0 = np.sin(dec0)
+    cos_dec0 = np.cos(dec0)
+    sin_psi = np.sin(psi)
+    cos_psi = np.cos(psi)
+    for t in prange(T):
+        for n in range(N):
+            x, y, visible = project_star(sin_a[t], cos_a[t], sin_ra[n], cos_ra[n], sin_dec[n], cos_dec[n],
+                                         sin_dec0, cos_dec0, sin_psi, cos_psi, f)
+            if visible:
+                i_out[t, n] = focal_index(x, pixel_size, half_gap, half_pixels)
+                j_out[t, n] = focal_index(y, pixel_size, half_gap, half_pixels)
+            else:
+                i_out[t, n] = -1
+                j_out[t, n] = -1
+
+
+@nb.njit(inline="always", cache=True)
+def star_pixel(sin_a, cos_a, sin_ra, cos_ra, sin_dec, cos_dec, sin_dec0, cos_dec0, sin_psi, cos_psi, f,
+               pixel_size, half_gap, half_pixels):
+    '''
+    Flat pixel index i*2*half_pixels+j of star, -1 when star is not on sensitive area
+    '''
+    x, y, visible = project_star(sin_a, cos_a, sin_ra, cos_ra, sin_dec, cos_dec,
+                                 sin_dec0, cos_dec0, sin_psi, cos_psi, f)
+    if not visible:
+        return -1
+    i = focal_index(x, pixel_size, half_gap, half_pixels)
+    j = focal_index(y, pixel_size, half_gap, half_pixels)
+    if i < 0 or j < 0:
+        return -1
+    return i*2*half_pixels+j
+
+
+@nb.njit(parallel=True, cache=True)
+def occupancy_counts(sin_a, cos_a, block_frames, block_start, block_end, candidates,
+                     sin_ra, cos_ra, sin_dec, cos_dec, dec0, psi, f, pixel_size, half_gap, half_pixels, counts):
+    '''
+    Number of stars in every pixel of every frame. Frames are processed in blocks,
+    stars candidates[block_start[b]:block_end[b]] are checked in block b.
+    :param counts: (T, P) zeroed output
+    '''
+    T = sin_a.shape[0]
+    B = block_start.shape[0]
+    sin_dec0 = np.sin(dec0)
+    cos_dec0 = np.cos(dec0)
+    sin_psi = np.sin(psi)
+    cos_psi = np.cos(psi)
+    for b in prange(B):
+        for t in range(b*block_frames, min(T, (b+1)*block_frames)):
+            for k in range(block_start[b], block_end[b]):
+                n = candidates[k]
+                p = star_pixel(sin_a[t], cos_a[t], sin_ra[n], cos_ra[n], sin_dec[n], cos_dec[n],
+                               sin_dec0, cos_dec0, sin_psi, cos_psi, f, pixel_size, half_gap, half_pixels)
+                if p >= 0:
+                    counts[t, p] += 1
+
+
+@nb.njit(parallel=True, cache=True)
+def occupancy_fill(sin_a, cos_a, block_frames, block_start, block_end, candidates,
+                   sin_ra, cos_ra, sin_dec, cos_dec, dec0, psi, f, pixel_size, half_gap, half_pixels,
+                   counts, frame_ptr, pixels_out, stars_out):
+    '''
+    Star lists of frames, entries frame_ptr[t]:frame_ptr[t+1] are sorted by pixel (see occupancy_counts)
+    '''
+    T, P = counts.shape
+    B = block_start.shape[0]
+    sin_dec0 = np.sin(dec0)
+    cos_dec0 = np.cos(dec0)
+    sin_psi = np.sin(psi)
+    cos_psi = np.cos(psi)
+    for b in prange(B):
+        cursor = np.empty(P, dtype=np.int64)
+        for t in range(b*block_frames, min(T, (b+1)*block_frames)):
+            position = frame_ptr[t]
+            for p in range(P):
+                cursor[p] = position
+                position += counts[t, p]
+            for k in range(block_start[b], block_end[b]):
+                n = candidates[k]
+                p = star_pixel(sin_a[t], cos_a[t], sin_ra[n], cos_ra[n], sin_dec[n], cos_dec[n],
+                               sin_dec0, cos_dec0, sin_psi, cos_psi, f, pixel_size, half_gap, half_pixels)
+                if p >= 0:
+                    pixels_out[cursor[p]] = p
+                    stars_out[cursor[p]] = n
+                    cursor[p] += 1